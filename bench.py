@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+# Benchmarks process.py and process-homicides.py on synthetic exports
+# shaped like cdc.tsv, cdc-all-deaths.txt, cdc-homicides.txt and
+# cdc-all-deaths-race-{female,male}.txt: the same columns, causes, ages,
+# genders, races and Hispanic origins, with deaths and populations made up.
+# Exports SCALE times the size of cdc.tsv cover SCALE times as many years.
+#
+# Parsing, aggregating and rendering are timed separately, taking the best
+# of --repeat runs of each:
+#
+#   parse      converting the exports into a fresh column cache
+#   aggregate  loading both scripts' datasets from that cache
+#   render     drawing and encoding each of both scripts' charts
+#
+#   ./bench.py                                 1x, 10x and 100x, as JSON
+#   ./bench.py --scales 1 10 --save baseline.json
+#   ./bench.py --scales 1 10 --baseline baseline.json
+#
+# With --baseline, phases more than --tolerance slower than the baseline
+# are reported, and the exit status is 1 if there are any.  Generated
+# exports are kept in BENCH_DIR so later runs can reuse them.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import charts
+import memo
+import wonder
+
+BENCH_DIR = ".bench"
+
+# Rows in cdc.tsv, and the years it covers.
+ROWS = 11110
+YEARS = 22
+FIRST_YEAR = 1999
+
+AGES = range(101)
+
+CAUSES = {
+    "W32": "Handgun discharge",
+    "W34": "Discharge from other and unspecified firearms",
+    "X72": "Intentional self-harm by handgun discharge",
+    "X73": "Intentional self-harm by rifle, shotgun and larger firearm "
+           "discharge",
+    "X74": "Intentional self-harm by other and unspecified firearm discharge",
+    "X93": "Assault by handgun discharge",
+    "X94": "Assault by rifle, shotgun and larger firearm discharge",
+    "X95": "Assault by other and unspecified firearm discharge",
+    "Y24": "Other and unspecified firearm discharge, undetermined intent",
+    "Y35.0": "Legal intervention involving firearm discharge",
+}
+
+GENDERS = {"Female": "F", "Male": "M"}
+
+RACES = {
+    "American Indian or Alaska Native": "1002-5",
+    "Asian or Pacific Islander": "A-PI",
+    "Black or African American": "2054-5",
+    "White": "2106-3",
+}
+
+HISPANIC_ORIGINS = {
+    "Hispanic or Latino": "2135-2",
+    "Not Hispanic or Latino": "2186-2",
+    "Not Stated": "NS",
+}
+
+# Rows a year in cdc-homicides.txt, and the first age WONDER gives no
+# single-year population for.
+HOMICIDE_ROWS = 1000
+UNPOPULATED_AGE = 85
+
+FIREARM_HEADER = ["Notes", "Year", "Year Code", "Single-Year Ages",
+                  "Single-Year Ages Code", "Cause of death",
+                  "Cause of death Code", "Gender", "Gender Code"]
+ALL_DEATHS_HEADER = ["Notes", "Year", "Year Code", "Single-Year Ages",
+                     "Single-Year Ages Code"]
+HOMICIDE_HEADER = ["Notes", "Year", "Year Code", "Single-Year Ages",
+                   "Single-Year Ages Code", "Hispanic Origin",
+                   "Hispanic Origin Code", "Gender", "Gender Code", "Race",
+                   "Race Code"]
+RACE_HEADER = ["Notes", "Year", "Year Code", "Single-Year Ages",
+               "Single-Year Ages Code", "Race", "Race Code",
+               "Hispanic Origin", "Hispanic Origin Code"]
+
+EXPORTS = ["cdc.tsv", "cdc-all-deaths.txt", "cdc-homicides.txt",
+           "cdc-all-deaths-race-female.txt", "cdc-all-deaths-race-male.txt"]
+
+# The scripts whose datasets and charts are timed, as modules.
+SCRIPTS = ["process", "process_homicides"]
+
+NOTES = ['"---"', '"Dataset: Synthetic, generated by bench.py"', '"---"']
+
+PHASES = ["parse", "aggregate", "render"]
+
+def quote(x):
+    return '"%s"' % x
+
+def age_label(age):
+    if age == 0:
+        return "< 1 year"
+    return "%s year%s" % (age, "" if age == 1 else "s")
+
+def header(cols):
+    return "\t".join([quote(col) for col in cols] +
+                     ["Deaths", "Population", "Crude Rate"])
+
+# Populations WONDER doesn't give are None.
+def count(population):
+    return "Not Applicable" if population is None else str(population)
+
+def crude_rate(deaths, population):
+    if population is None:
+        return "Not Applicable"
+    if deaths <= 20:
+        return "Unreliable"
+    return "%.1f" % (deaths * 100000 / population)
+
+def write_exports(directory, scale, seed=0):
+    rng = np.random.default_rng(seed)
+    combos = [(age, cause, gender)
+              for age in AGES for cause in CAUSES for gender in GENDERS]
+    per_year = ROWS // YEARS
+
+    with open(os.path.join(directory, "cdc.tsv"), "w") as firearm, \
+         open(os.path.join(directory, "cdc-all-deaths.txt"), "w") as everyone:
+        firearm.write(header(FIREARM_HEADER) + "\n")
+        everyone.write(header(ALL_DEATHS_HEADER) + "\n")
+
+        for year in range(FIRST_YEAR, FIRST_YEAR + YEARS * scale):
+            # Even, so each gender's half adds back up to the whole, as
+            # process.py checks.
+            populations = 2 * rng.integers(500000, 1100000, size=len(AGES))
+            deaths = rng.integers(1, 400, size=per_year)
+            for i, combo in enumerate(sorted(
+                    rng.choice(len(combos), per_year, replace=False))):
+                age, cause, gender = combos[combo]
+                population = int(populations[age]) // 2
+                firearm.write("\t".join([
+                    "", quote(year), quote(year), quote(age_label(age)),
+                    quote(age), quote(CAUSES[cause]), quote(cause),
+                    quote(gender), quote(GENDERS[gender]), str(deaths[i]),
+                    str(population), crude_rate(deaths[i], population),
+                ]) + "\n")
+
+            all_deaths = rng.integers(1000, 60000, size=len(AGES))
+            for age in AGES:
+                everyone.write("\t".join([
+                    "", quote(year), quote(year), quote(age_label(age)),
+                    quote(age), str(all_deaths[age]), str(populations[age]),
+                    crude_rate(all_deaths[age], populations[age]),
+                ]) + "\n")
+
+        firearm.write("\n".join(NOTES))
+        everyone.write("\n".join(NOTES))
+
+    write_homicide_exports(directory, scale, rng)
+
+# cdc-homicides.txt and the per-gender all-deaths exports by race and
+# Hispanic origin, covering the same years as write_exports().
+def write_homicide_exports(directory, scale, rng):
+    combos = [(age, hispanic, gender, race)
+              for age in AGES for hispanic in HISPANIC_ORIGINS
+              for gender in GENDERS for race in RACES]
+
+    path = lambda fname: os.path.join(directory, fname)
+    with open(path("cdc-homicides.txt"), "w") as homicides, \
+         open(path("cdc-all-deaths-race-female.txt"), "w") as female, \
+         open(path("cdc-all-deaths-race-male.txt"), "w") as male:
+        everyone = {"Female": female, "Male": male}
+        homicides.write(header(HOMICIDE_HEADER) + "\n")
+        for outf in everyone.values():
+            outf.write(header(RACE_HEADER) + "\n")
+
+        for year in range(FIRST_YEAR, FIRST_YEAR + YEARS * scale):
+            populations = {
+                (age, hispanic, gender, race):
+                    int(rng.integers(10000, 900000))
+                    if age < UNPOPULATED_AGE else None
+                for age, hispanic, gender, race in combos}
+
+            deaths = rng.integers(1, 50, size=HOMICIDE_ROWS)
+            for i, combo in enumerate(sorted(
+                    rng.choice(len(combos), HOMICIDE_ROWS, replace=False))):
+                age, hispanic, gender, race = combos[combo]
+                population = populations[combos[combo]]
+                homicides.write("\t".join([
+                    "", quote(year), quote(year), quote(age_label(age)),
+                    quote(age), quote(hispanic),
+                    quote(HISPANIC_ORIGINS[hispanic]), quote(gender),
+                    quote(GENDERS[gender]), quote(race), quote(RACES[race]),
+                    str(deaths[i]), count(population),
+                    crude_rate(deaths[i], population),
+                ]) + "\n")
+
+            all_deaths = rng.integers(10, 3000, size=len(combos))
+            for combo, deaths in zip(combos, all_deaths):
+                age, hispanic, gender, race = combo
+                population = populations[combo]
+                everyone[gender].write("\t".join([
+                    "", quote(year), quote(year), quote(age_label(age)),
+                    quote(age), quote(race), quote(RACES[race]),
+                    quote(hispanic), quote(HISPANIC_ORIGINS[hispanic]),
+                    str(deaths), count(population),
+                    crude_rate(deaths, population),
+                ]) + "\n")
+
+        homicides.write("\n".join(NOTES))
+        for outf in everyone.values():
+            outf.write("\n".join(NOTES))
+
+# The directory holding exports at scale, generating them if need be.
+def exports(scale):
+    directory = os.path.join(BENCH_DIR, "%sx" % scale)
+    if not all(os.path.exists(os.path.join(directory, fname))
+               for fname in EXPORTS):
+        tmp = "%s.%s.tmp" % (directory, os.getpid())
+        os.makedirs(tmp)
+        write_exports(tmp, scale)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp, directory)
+    return directory
+
+def best(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def forget():
+    charts.loaded.clear()
+    memo.cache.clear()
+
+def run(scale, repeat, phases):
+    directory = os.path.abspath(exports(scale))
+    result = {
+        "rows": ROWS * scale,
+        "bytes": sum(os.path.getsize(os.path.join(directory, fname))
+                     for fname in os.listdir(directory)),
+    }
+    datasets = [func for (module, name), func in charts.DATASETS.items()
+                if module in SCRIPTS]
+    drawn = [c for c in charts.CHARTS.values()
+             if c.draw.__module__ in SCRIPTS]
+
+    here = os.getcwd()
+    cache = tempfile.mkdtemp(prefix="bench-cache-")
+    try:
+        os.chdir(directory)
+        wonder.CACHE_DIR = cache
+
+        def parse():
+            shutil.rmtree(cache)
+            for fname in EXPORTS:
+                wonder.read_export(fname)
+        def aggregate():
+            forget()
+            for func in datasets:
+                charts.load(func)
+
+        # Later phases need the cache and datasets the earlier ones leave.
+        parse_time = best(parse, repeat)
+        if "parse" in phases:
+            result["parse"] = parse_time
+        aggregate_time = best(aggregate, repeat)
+        if "aggregate" in phases:
+            result["aggregate"] = aggregate_time
+        if "render" in phases:
+            result["charts"] = {
+                c.name: best(lambda: c.draw_image("png"), repeat)
+                for c in drawn}
+            result["render"] = sum(result["charts"].values())
+    finally:
+        os.chdir(here)
+        shutil.rmtree(cache, ignore_errors=True)
+        forget()
+    return result
+
+def environment():
+    import matplotlib
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "jobs": wonder.JOBS,
+    }
+
+# (scale, phase, baseline, now) for each phase that's slower than the
+# baseline by more than tolerance, ignoring differences under noise
+# seconds.
+def regressions(results, baseline, tolerance, noise=0.05):
+    slower = []
+    for scale, result in results["results"].items():
+        before = baseline["results"].get(scale, {})
+        for phase in PHASES:
+            if phase not in result or phase not in before:
+                continue
+            if (result[phase] > before[phase] * (1 + tolerance)
+                    and result[phase] - before[phase] > noise):
+                slower.append((scale, phase, before[phase], result[phase]))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=[1, 10, 100],
+        help="sizes of export to benchmark, as multiples of cdc.tsv")
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="time each phase this many times, keeping the best")
+    parser.add_argument(
+        "--phases", nargs="+", choices=PHASES, default=PHASES)
+    parser.add_argument(
+        "--save", metavar="FILE", help="write results here as well")
+    parser.add_argument(
+        "--baseline", metavar="FILE",
+        help="compare against results saved earlier with --save")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25,
+        help="how much slower than the baseline a phase can be, as a "
+        "fraction (default 0.25)")
+    args = parser.parse_args()
+
+    charts.load_scripts()
+    results = {
+        "environment": environment(),
+        "results": {str(scale): run(scale, args.repeat, args.phases)
+                    for scale in args.scales},
+    }
+
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    if args.save:
+        with open(args.save, "w") as outf:
+            json.dump(results, outf, indent=2)
+            outf.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as inf:
+            baseline = json.load(inf)
+        slower = regressions(results, baseline, args.tolerance)
+        for scale, phase, before, now in slower:
+            print("%sx %s: %.3fs -> %.3fs (%+.0f%%)" % (
+                scale, phase, before, now, (now / before - 1) * 100),
+                  file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
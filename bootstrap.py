@@ -0,0 +1,93 @@
+# Parametric bootstrap bands for rates.rate() and rates.adjusted(): deaths
+# in every cell and age group are redrawn from a Poisson distribution
+# around what was counted, population is held fixed, and the band is the
+# spread of the rates recomputed from each draw.
+#
+# The draws for a batch of cells are one array, (samples, cells, groups),
+# and a batch's rates and quantiles are a handful of reductions over it,
+# so no cell is ever sampled on its own.  Cells are batched so that a
+# batch holds about BATCH values, which keeps memory flat however large
+# the grid is; with jobs, batches are spread across a pool of processes.
+# Each batch has its own seed, spawned from seed, so bands come out the
+# same however many jobs draw them.
+#
+#   low, high = bootstrap.bands(data, pops, by="year",
+#                               strata={"age": (13, 17)})
+
+import multiprocessing
+
+import numpy as np
+
+import instrument
+import rates
+
+# Draws per cell.
+SAMPLES = 1000
+
+# Values drawn per batch: 8 bytes each, several times over.
+BATCH = 1 << 22
+
+# (low, high) rates.interval() would give, but from samples draws.  With
+# standard, bands for rates.adjusted().
+def bands(numerator, denominator, causes=None, strata=None, by=(),
+          per=100000, standard=None, level=rates.LEVEL, samples=SAMPLES,
+          jobs=1, seed=0):
+    strata = rates.select(causes, strata)
+    top, bottom, weights = rates.grouped(numerator, denominator, strata, by,
+                                         standard)
+    shape = top.shape[:-1]
+    groups = top.shape[-1]
+    top = top.reshape(-1, groups)
+    bottom = bottom.reshape(-1, groups)
+
+    with instrument.phase("bootstrap", rows=len(top) * samples):
+        if groups == 1:
+            # A crude rate is its cell's deaths, scaled, so cells with the
+            # same deaths can share draws: only each distinct count is
+            # sampled, however many cells there are.
+            counts, cells = np.unique(top, return_inverse=True)
+            result = quantiles(counts[:, None], np.ones((len(counts), 1)),
+                               weights, 1, level, samples, jobs, seed)
+            result = np.divide(result[:, cells.ravel()] * per, bottom[:, 0],
+                               out=np.full((2, len(top)), float("NaN")),
+                               where=bottom[:, 0] > 0)
+        else:
+            result = quantiles(top, bottom, weights, per, level, samples,
+                               jobs, seed)
+
+    low, high = result.reshape((2,) + shape)
+    missing = rates.gaps(denominator, strata, by, shape)
+    low[missing] = high[missing] = float("NaN")
+    xs, low, high = rates.series(rates.labels(numerator, strata, by), by,
+                                 low, high)
+    return low, high
+
+# The low and high quantiles, at level, of each cell's standardized rate
+# over samples draws of its deaths, as a (2, cells) array.
+def quantiles(top, bottom, weights, per, level, samples, jobs, seed):
+    step = max(1, BATCH // (samples * top.shape[-1]))
+    starts = range(0, len(top), step)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    batches = [(top[i:i + step], bottom[i:i + step], weights, per, samples,
+                [(1 - level) / 2, (1 + level) / 2], s)
+               for i, s in zip(starts, seeds)]
+
+    # Pool workers, like charts.py's, can't start pools of their own.
+    if (jobs > 1 and len(batches) > 1
+            and not multiprocessing.current_process().daemon):
+        with multiprocessing.Pool(min(jobs, len(batches))) as pool:
+            results = pool.map(sample, batches)
+    else:
+        results = [sample(batch) for batch in batches]
+    return np.concatenate([np.empty((2, 0))] + results, axis=1)
+
+# The quantiles of a batch's rates over its draws.
+def sample(batch):
+    top, bottom, weights, per, samples, levels, seed = batch
+    rng = np.random.default_rng(seed)
+    draws = rng.poisson(top, size=(samples,) + top.shape)
+    ys = rates.standardize(draws, bottom, weights, per)
+    result = np.full((2, len(top)), float("NaN"))
+    defined = ~np.isnan(ys[0])
+    result[:, defined] = np.quantile(ys[:, defined], levels, axis=0)
+    return result
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+# Registry and rendering for the charts process.py and process-homicides.py
+# define.
+#
+# The data a chart draws on comes from datasets: functions registered with
+# @dataset, which run at most once, the first time something needs them.
+# Each chart is a function registered with @chart along with where its
+# figure is saved.  It draws the figure and returns it, and its parameters
+# name the datasets it needs, so rendering a few charts only loads what
+# those charts use.  Datasets can take other datasets the same way.
+#
+# Run this file to render charts from both scripts, or a script to render
+# its own:
+#
+#   ./charts.py --list
+#   ./charts.py 'youth-*' firearm-homicide-rate-by-age-big
+#   ./process-homicides.py -j 8
+#
+# Tables, registered with @table, are the numbers behind the charts as rows
+# of {column: value}.  --data prints them as CSV or JSON instead of
+# rendering anything, and never imports matplotlib:
+#
+#   ./process.py --data csv suicide-rate-by-age
+#   ./charts.py --data json
+#
+# materialize.py writes them out as Parquet or Arrow datasets instead.
+#
+# matplotlib is only imported once a figure is drawn; scripts refer to it
+# through Lazy modules so that they can be imported without it.
+#
+# With -j the charts are rendered across a pool of processes forked after
+# their datasets are loaded, so workers share those arrays rather than
+# loading their own.  Where the platform can't fork, rendering is serial.
+#
+# --formats writes each chart in several formats, from outputs.py, drawing
+# it only once.
+#
+# --intervals shades the confidence interval around each rate a chart
+# draws with plot(): poisson for rates.interval(), bootstrap for
+# bootstrap.bands().
+#
+# --report and --cprofile time each export, dataset and chart, as described
+# in instrument.py.
+#
+# Charts are only rendered when something they depend on has changed.  A
+# chart's fingerprint covers its code, the code of the datasets it draws
+# on and the export files they read, the module-level constants and
+# helpers any of these use, and the savefig arguments.  MANIFEST keeps the
+# fingerprint each output was last rendered with, along with a hash of the
+# output itself; when both still match, the chart is skipped.  --force
+# renders everything regardless.
+
+import argparse
+import csv
+import fnmatch
+import hashlib
+import importlib.metadata
+import importlib.util
+import inspect
+import io
+import json
+import multiprocessing
+import os
+import sys
+import types
+
+import bootstrap
+import instrument
+import memo
+import outputs
+import rates
+import wonder
+
+# Scripts whose charts ./charts.py knows about.
+SCRIPTS = ["process.py", "process-homicides.py"]
+
+# name -> Chart, in the order they were registered
+CHARTS = {}
+
+# name -> Table, in the order they were registered
+TABLES = {}
+
+# (module, name) -> function loading the dataset
+DATASETS = {}
+
+# function -> export files it reads
+SOURCES = {}
+
+# output -> {"fingerprint": ..., "output": hash of the output file}
+MANIFEST = ".chart-fingerprints.json"
+
+# function -> what it returned
+loaded = {}
+
+# module -> library_fingerprint() of its functions
+libraries = {}
+
+# How plot() shades confidence intervals: None, "poisson" or "bootstrap".
+INTERVALS = None
+
+# How many processes bootstrap.bands() samples across for plot().
+JOBS = 1
+
+class Lazy:
+    # A module imported the first time one of its attributes is used.
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.name), attr)
+
+plt = Lazy("matplotlib.pyplot")
+
+class Chart:
+    def __init__(self, draw, output, savefig, spec=None):
+        self.draw = draw
+        self.output = output
+        self.name = os.path.splitext(os.path.basename(output))[0]
+        self.inputs = [name for name in inspect.signature(draw).parameters
+                       if name != "spec"]
+        # Extra arguments to fig.savefig(), like dpi.
+        self.savefig = savefig
+        # For charts drawn from a spec in a config file, like strata.json,
+        # passed to draw as spec.
+        self.spec = spec
+
+    def figure(self, inputs):
+        if self.spec is None:
+            return self.draw(**inputs)
+        return self.draw(spec=self.spec, **inputs)
+
+    def load(self):
+        return {name: load(DATASETS[self.draw.__module__, name])
+                for name in self.inputs}
+
+    # Where the chart is written in the given format from outputs.FORMATS.
+    def path(self, fmt):
+        base, ext = os.path.splitext(self.output)
+        suffix = outputs.FORMATS[fmt].suffix
+        return self.output if suffix == ext else base + suffix
+
+    # Draws the chart once and writes it out in each of formats.
+    def render(self, formats=("png",)):
+        inputs = self.load()
+        with instrument.phase("chart %s" % self.name):
+            with instrument.phase("draw"):
+                fig = self.figure(inputs)
+            for fmt in formats:
+                with instrument.phase("save %s" % fmt), \
+                     open(self.path(fmt), "wb") as outf:
+                    outputs.FORMATS[fmt].write(fig, self, outf)
+            plt.close(fig)
+
+    # The chart in the given format, without writing it out.  Kept in
+    # memo.cache: the datasets it draws on don't change once loaded.
+    def image(self, fmt="png"):
+        return memo.cache.get(("image", self.name, fmt),
+                              lambda: self.draw_image(fmt))
+
+    def draw_image(self, fmt):
+        fig = self.figure(self.load())
+        buf = io.BytesIO()
+        outputs.FORMATS[fmt].write(fig, self, buf)
+        plt.close(fig)
+        return buf.getvalue()
+
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        for part in [code_fingerprint(self.draw),
+                     library_fingerprint(self.draw),
+                     repr(sorted(self.savefig.items())),
+                     json.dumps(self.spec, sort_keys=True),
+                     repr(INTERVALS),
+                     importlib.metadata.version("matplotlib")]:
+            digest.update(part.encode())
+        for name in self.inputs:
+            digest.update(dataset_fingerprint(
+                DATASETS[self.draw.__module__, name]).encode())
+        return digest.hexdigest()
+
+class Table:
+    def __init__(self, rows, name):
+        self.rows = rows
+        self.name = name
+        self.inputs = list(inspect.signature(rows).parameters)
+
+    # The table as a list of {column: value}.
+    def compute(self):
+        return self.rows(**load_inputs(self.rows))
+
+def chart(output, spec=None, **savefig):
+    def register(draw):
+        c = Chart(draw, output, savefig, spec)
+        CHARTS[c.name] = c
+        return draw
+    return register
+
+def table(name):
+    def register(rows):
+        TABLES[name] = Table(rows, name)
+        return rows
+    return register
+
+# Registers a dataset, along with the export files it reads.
+def dataset(*sources):
+    def register(func):
+        DATASETS[func.__module__, func.__name__] = func
+        SOURCES[func] = list(sources)
+        return func
+    return register
+
+def load(func):
+    if func not in loaded:
+        inputs = load_inputs(func)
+        with instrument.phase("dataset %s.%s" % (
+                func.__module__, func.__name__)):
+            loaded[func] = func(**inputs)
+    return loaded[func]
+
+# The datasets func's parameters name, loaded.
+def load_inputs(func):
+    return {name: load(DATASETS[func.__module__, name])
+            for name in inspect.signature(func).parameters}
+
+# The source of func, plus that of the functions and the values of the
+# constants it refers to in its own module, recursively.
+def code_fingerprint(func, seen=None):
+    if seen is None:
+        seen = set()
+    seen.add(func)
+
+    parts = [inspect.getsource(func)]
+    codes = [func.__code__]
+    while codes:
+        code = codes.pop()
+        codes.extend(c for c in code.co_consts
+                     if isinstance(c, types.CodeType))
+        for name in code.co_names:
+            value = func.__globals__.get(name)
+            if isinstance(value, types.FunctionType):
+                if value.__module__ == func.__module__ and value not in seen:
+                    parts.append(code_fingerprint(value, seen))
+            elif isinstance(value, set):
+                parts.append("%s = %r" % (name, sorted(value)))
+            elif isinstance(value, (str, int, float, list, tuple, dict)):
+                parts.append("%s = %r" % (name, value))
+    return "\n".join(parts)
+
+# The source of this project's modules that func's module imports, directly
+# or through one another: charts.py, rates.py, wonder.py and so on, which
+# code_fingerprint() doesn't follow calls into.
+def library_fingerprint(func):
+    if func.__module__ not in libraries:
+        here = os.path.dirname(os.path.abspath(__file__))
+        sources = {}
+        spaces = [func.__globals__]
+        while spaces:
+            for value in list(spaces.pop().values()):
+                path = getattr(value, "__file__", None) \
+                    if isinstance(value, types.ModuleType) else None
+                if (path and os.path.dirname(os.path.abspath(path)) == here
+                        and os.path.basename(path) not in sources):
+                    with open(path) as inf:
+                        sources[os.path.basename(path)] = inf.read()
+                    spaces.append(vars(value))
+        libraries[func.__module__] = "\n".join(
+            sources[name] for name in sorted(sources))
+    return libraries[func.__module__]
+
+def dataset_fingerprint(func):
+    digest = hashlib.sha256()
+    digest.update(code_fingerprint(func).encode())
+    digest.update(library_fingerprint(func).encode())
+    digest.update(str(wonder.PARSER_VERSION).encode())
+    for fname in SOURCES[func]:
+        digest.update(wonder.source_hash(fname).encode())
+    for name in inspect.signature(func).parameters:
+        digest.update(dataset_fingerprint(
+            DATASETS[func.__module__, name]).encode())
+    return digest.hexdigest()
+
+# Plots the rates rates.rate() gives, or with standard, rates.adjusted(),
+# as a line on ax, with INTERVALS shading around it.  Returns the rates.
+def plot(ax, numerator, denominator, causes=None, strata=None, by=(),
+         per=100000, standard=None, **style):
+    query = dict(causes=causes, strata=strata, by=by, per=per)
+    if standard is None:
+        xs, ys = rates.rate(numerator, denominator, **query)
+    else:
+        xs, ys = rates.adjusted(numerator, denominator, standard=standard,
+                                **query)
+    line, = ax.plot(xs, ys, **style)
+
+    if INTERVALS == "poisson":
+        low, high = rates.interval(numerator, denominator,
+                                   standard=standard, **query)
+    elif INTERVALS == "bootstrap":
+        low, high = bootstrap.bands(numerator, denominator,
+                                    standard=standard, jobs=JOBS, **query)
+    if INTERVALS:
+        ax.fill_between(xs, low, high, color=line.get_color(), alpha=0.2,
+                        linewidth=0)
+    return xs, ys
+
+def read_manifest():
+    try:
+        with open(MANIFEST) as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return {}
+
+def write_manifest(manifest):
+    tmp = "%s.%s.tmp" % (MANIFEST, os.getpid())
+    with open(tmp, "w") as outf:
+        json.dump(manifest, outf, indent=2, sort_keys=True)
+    os.replace(tmp, MANIFEST)
+
+def up_to_date(path, fingerprint, manifest):
+    entry = manifest.get(path)
+    return (entry is not None
+            and entry["fingerprint"] == fingerprint
+            and os.path.exists(path)
+            and entry["output"] == wonder.file_hash(path))
+
+# Runs in a pool worker, which has its own copy of everything loaded.
+# Returns what instrument recorded while rendering, for the parent's
+# report.
+def render_chart(args):
+    name, formats = args
+    start = len(instrument.records)
+    CHARTS[name].render(formats)
+    return instrument.records[start:]
+
+def render_all(charts, jobs, formats=("png",)):
+    jobs = min(jobs, len(charts))
+    if jobs <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for c in charts:
+            c.render(formats)
+        return
+
+    for c in charts:
+        c.load()
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        for records in pool.map(render_chart,
+                                [(c.name, formats) for c in charts],
+                                chunksize=1):
+            instrument.records.extend(records)
+
+# Renders whichever of charts are out of date in any of formats, or all of
+# them with force.
+def render(charts, jobs=1, force=False, formats=("png",)):
+    manifest = read_manifest()
+    fingerprints = {c.name: c.fingerprint() for c in charts}
+    stale = [c for c in charts
+             if force or not all(
+                     up_to_date(c.path(fmt), fingerprints[c.name], manifest)
+                     for fmt in formats)]
+
+    # Datasets check what they load, so a missing export or one with gaps
+    # stops everything before any chart is drawn.
+    for c in stale:
+        c.load()
+    render_all(stale, jobs, formats)
+
+    for c in stale:
+        for fmt in formats:
+            manifest[c.path(fmt)] = {
+                "fingerprint": fingerprints[c.name],
+                "output": wonder.file_hash(c.path(fmt)),
+            }
+    write_manifest(manifest)
+
+# Writes tables to outf, as CSV with a "# name" line before each table when
+# there are several, or as one JSON object keyed by name.
+def write_tables(tables, fmt, outf):
+    if fmt == "json":
+        json.dump({t.name: t.compute() for t in tables}, outf, indent=2)
+        outf.write("\n")
+        return
+
+    for i, t in enumerate(tables):
+        rows = t.compute()
+        if len(tables) > 1:
+            outf.write("%s# %s\n" % ("\n" if i else "", t.name))
+        writer = csv.DictWriter(outf, fieldnames=list(rows[0]) if rows else [],
+                                lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+# The registered charts, or tables, matching any of the given names or glob
+# patterns, or all of them if there are none.
+def select(patterns, registry=CHARTS):
+    if not patterns:
+        return list(registry.values())
+
+    selected = []
+    for pattern in patterns:
+        matches = [c for c in registry.values()
+                   if fnmatch.fnmatch(c.name, pattern)
+                   or fnmatch.fnmatch(getattr(c, "output", c.name), pattern)]
+        if not matches:
+            sys.exit("nothing matches %r; try --list" % pattern)
+        selected.extend(c for c in matches if c not in selected)
+    return selected
+
+def load_scripts():
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fname in SCRIPTS:
+        name = os.path.splitext(fname)[0].replace("-", "_")
+        if name in sys.modules:
+            continue
+        spec = importlib.util.spec_from_file_location(
+            name, os.path.join(here, fname))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+def formats(names):
+    names = names.split(",")
+    for name in names:
+        if name not in outputs.FORMATS:
+            raise argparse.ArgumentTypeError("no format %r" % name)
+    return names
+
+# Returns whether it rendered charts, rather than listing them or printing
+# tables.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "charts", nargs="*", metavar="CHART",
+        help="names or glob patterns of charts to render (default: all)")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="render this many charts at once, or one per CPU with 0; "
+        "bootstrap intervals sample across as many processes")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="render charts even if nothing they depend on has changed")
+    parser.add_argument(
+        "--formats", type=formats, default=["png"], metavar="FORMAT,...",
+        help="write charts in each of these formats: %s (default: png)" %
+        ", ".join(outputs.FORMATS))
+    parser.add_argument(
+        "--intervals", choices=["poisson", "bootstrap"],
+        help="shade confidence intervals around rates")
+    parser.add_argument(
+        "--list", action="store_true",
+        help="list charts with their inputs instead of rendering them")
+    parser.add_argument(
+        "--data", choices=["csv", "json"],
+        help="print tables in this format instead of rendering charts")
+    parser.add_argument(
+        "--report", metavar="FILE",
+        help="write how long each phase and chart took, and the memory it "
+        "used, to FILE as JSON, or to stderr with -")
+    parser.add_argument(
+        "--cprofile", metavar="FILE", help="dump cProfile stats to FILE")
+    args = parser.parse_args()
+    instrument.enable(args.report, args.cprofile)
+    global INTERVALS, JOBS
+    INTERVALS = args.intervals
+    JOBS = args.jobs or os.cpu_count()
+    try:
+        return run(args)
+    except wonder.CoverageError as e:
+        sys.exit(str(e))
+
+# What main() does with its arguments.
+def run(args):
+    if args.data:
+        tables = select(args.charts, TABLES)
+        if args.list:
+            for t in tables:
+                print("%s\t%s" % (t.name, ",".join(t.inputs)))
+        else:
+            write_tables(tables, args.data, sys.stdout)
+        return
+
+    charts = select(args.charts)
+    if args.list:
+        for c in charts:
+            print("%s\t%s\t%s" % (c.name, ",".join(c.inputs), c.output))
+        return
+
+    render(charts, args.jobs or os.cpu_count(), args.force, args.formats)
+    return True
+
+if __name__ == "__main__":
+    # The scripts register with the imported module, not with __main__.
+    import charts
+    charts.load_scripts()
+    charts.main()
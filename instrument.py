@@ -0,0 +1,120 @@
+# Opt-in timing of what a run spends its time and memory on.  Set
+# INSTRUMENT to a file name, or to - for stderr, or pass --report to
+# ./charts.py or either script, and each phase of the run is recorded:
+#
+#   parse EXPORT, load EXPORT   converting an export, or mapping in its cache
+#   dataset MODULE.NAME         building a dataset from exports
+#   chart NAME                  a chart, made up of draw and save
+#
+# For each phase, the report gives wall and CPU seconds, the rows it
+# handled where that makes sense, and how far memory allocated while it ran
+# peaked above where it started, by way of tracemalloc.  Tracing slows
+# allocation down, so times are somewhat inflated.  Phases within phases
+# are named by path, like "chart firearms-deaths-by-age-big/save".  The
+# report is JSON, written when the run exits.
+#
+# INSTRUMENT_CPROFILE, or --cprofile, names a file to dump cProfile stats
+# to as well, which pstats, snakeviz or flameprof can read.
+#
+# With neither set, phase() costs next to nothing.
+
+import atexit
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+# Finished phases, in the order they finished.
+records = []
+
+# Phases under way, innermost last.
+stack = []
+
+report_path = None
+profiler = None
+
+class Phase:
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        if report_path is None:
+            return self
+        if stack:
+            # Its own peak is what it allocates from here on.
+            note_peak(stack[-1])
+        self.peak = 0
+        self.base = tracemalloc.get_traced_memory()[0]
+        self.path = "/".join([p.name for p in stack] + [self.name])
+        stack.append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        if report_path is None or not stack or stack[-1] is not self:
+            return
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        stack.pop()
+        note_peak(self)
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        record = {"phase": self.path, "wall": wall, "cpu": cpu,
+                  "peak_bytes": max(self.peak - self.base, 0),
+                  "pid": os.getpid()}
+        if self.rows is not None:
+            record["rows"] = int(self.rows)
+        records.append(record)
+
+# Folds the peak allocated since the last call into phase, and starts
+# over.
+def note_peak(phase):
+    current, peak = tracemalloc.get_traced_memory()
+    phase.peak = max(phase.peak, peak)
+    tracemalloc.reset_peak()
+
+def phase(name, rows=None):
+    return Phase(name, rows)
+
+def enabled():
+    return report_path is not None
+
+def enable(path, cprofile=None):
+    global report_path, profiler
+    if report_path is None and path:
+        report_path = path
+        tracemalloc.start()
+        atexit.register(write_report)
+    if profiler is None and cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(write_profile, cprofile)
+
+def report():
+    # ru_maxrss is in kilobytes, except on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "argv": sys.argv,
+        "phases": records,
+        "max_rss_bytes": rss if sys.platform == "darwin" else rss * 1024,
+    }
+
+def write_report():
+    if report_path == "-":
+        json.dump(report(), sys.stderr, indent=2)
+        sys.stderr.write("\n")
+        return
+    with open(report_path, "w") as outf:
+        json.dump(report(), outf, indent=2)
+        outf.write("\n")
+
+def write_profile(path):
+    profiler.disable()
+    profiler.dump_stats(path)
+
+enable(os.environ.get("INSTRUMENT"), os.environ.get("INSTRUMENT_CPROFILE"))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Writes the tables process.py and process-homicides.py register with
+# @table to disk as columnar datasets, so notebooks and the dashboard can
+# read the numbers behind the charts instead of rerunning the scripts:
+#
+#   ./materialize.py                          every table, as Parquet
+#   ./materialize.py --format arrow 'rates-by-*'
+#
+# Each table is a directory under --out.  Tables with a year column are
+# partitioned by it, Hive style, as year=1999/part-0.parquet and so on, so
+# a reader filtering on year only opens the files for those years:
+#
+#   import pyarrow.dataset as ds
+#   ds.dataset("tables/rates-by-motive", partitioning="hive").to_table(
+#       filter=ds.field("year") >= 2015)
+#
+# A table goes to Arrow in one conversion from its rows and out in one
+# write, replacing what was there before.  This needs pyarrow, which
+# nothing else does.
+
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+
+import charts
+import instrument
+import wonder
+
+pa = charts.Lazy("pyarrow")
+ds = charts.Lazy("pyarrow.dataset")
+
+OUT = "tables"
+
+# --format -> pyarrow.dataset format
+FORMATS = {
+    "parquet": "parquet",
+    "arrow": "ipc",
+}
+
+# Writes table to a directory named for it under out.  Returns how many
+# rows it had.
+def write_table(table, out, fmt):
+    rows = table.compute()
+    arrow = pa.Table.from_pylist(rows)
+    partitioning = ["year"] if "year" in arrow.column_names else None
+
+    path = os.path.join(out, table.name)
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    ds.write_dataset(arrow, tmp, format=FORMATS[fmt],
+                     partitioning=partitioning,
+                     partitioning_flavor="hive" if partitioning else None)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "tables", nargs="*", metavar="TABLE",
+        help="names or glob patterns of tables to write (default: all)")
+    parser.add_argument(
+        "--out", default=OUT, help="directory to write tables under "
+        "(default: %s)" % OUT)
+    parser.add_argument(
+        "--format", choices=FORMATS, default="parquet")
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("pyarrow") is None:
+        sys.exit("materialize.py needs pyarrow: pip install pyarrow")
+
+    charts.load_scripts()
+    os.makedirs(args.out, exist_ok=True)
+    for table in charts.select(args.tables, charts.TABLES):
+        try:
+            with instrument.phase("table %s" % table.name) as phase:
+                phase.rows = write_table(table, args.out, args.format)
+        except wonder.CoverageError as e:
+            sys.exit(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Remembers aggregates and rendered charts so that charts and queries asking
+# for the same thing share the work.  Entries are dropped least recently
+# used first once together they'd take more than the budget, which is
+# MEMO_BUDGET_MB megabytes (default 256), or nothing at all with 0.
+#
+# Keys must identify everything the value depends on: rates.total() keys on
+# the cube's version, which changes whenever its values do.
+
+import collections
+import os
+import sys
+
+import numpy as np
+
+BUDGET = int(os.environ.get("MEMO_BUDGET_MB", "256")) << 20
+
+# Bytes value takes up, near enough.
+def sizeof(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+# A hashable stand-in for a query parameter, so lists, sets and arrays can
+# go in keys.
+def freeze(value):
+    if isinstance(value, np.ndarray):
+        return ("array", value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, dict):
+        return tuple(sorted(((freeze(k), freeze(v)) for k, v in value.items()),
+                            key=repr))
+    if isinstance(value, (set, frozenset)):
+        return ("set",) + tuple(sorted((freeze(v) for v in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(freeze(v) for v in value)
+    return value
+
+class LRU:
+    def __init__(self, budget):
+        self.budget = budget
+        # key -> (value, size), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    # The value for key, calling compute() for it if it isn't here.
+    def get(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        size = sizeof(value)
+        if size > self.budget:
+            return
+        while self.size + size > self.budget:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+        self.entries[key] = value, size
+        self.size += size
+
+    def resize(self, budget):
+        self.budget = budget
+        while self.size > self.budget:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size,
+                "budget": self.budget, "hits": self.hits,
+                "misses": self.misses}
+
+cache = LRU(BUDGET)
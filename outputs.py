@@ -0,0 +1,98 @@
+# The formats a drawn chart can be written out in.  A chart's figure is
+# drawn once and then written in each format asked for, so adding formats
+# costs their encoding, not another pass over the data:
+#
+#   ./charts.py --formats png,svg,thumb,json
+#
+# Each format is a function registered with @output, which writes the
+# figure of a Chart to a binary file.  Where it's written is the chart's
+# output with the format's suffix in place of the extension.
+
+import json
+import math
+
+import numpy as np
+
+# Pixels per inch for thumbnails, against 100 for charts by default.
+THUMBNAIL_DPI = 30
+
+# name -> Format, in the order they were registered
+FORMATS = {}
+
+class Format:
+    def __init__(self, write, name, suffix, content_type):
+        self.write = write
+        self.name = name
+        self.suffix = suffix
+        self.content_type = content_type
+
+def output(name, suffix, content_type):
+    def register(write):
+        FORMATS[name] = Format(write, name, suffix, content_type)
+        return write
+    return register
+
+@output("png", ".png", "image/png")
+def png(fig, chart, outf):
+    fig.savefig(outf, format="png", **chart.savefig)
+
+@output("svg", ".svg", "image/svg+xml")
+def svg(fig, chart, outf):
+    fig.savefig(outf, format="svg", **chart.savefig)
+
+@output("pdf", ".pdf", "application/pdf")
+def pdf(fig, chart, outf):
+    fig.savefig(outf, format="pdf", **chart.savefig)
+
+@output("webp", ".webp", "image/webp")
+def webp(fig, chart, outf):
+    fig.savefig(outf, format="webp", **chart.savefig)
+
+@output("thumb", "-thumb.png", "image/png")
+def thumbnail(fig, chart, outf):
+    fig.savefig(outf, format="png", **dict(chart.savefig, dpi=THUMBNAIL_DPI))
+
+# What's plotted, for drawing the chart client-side instead.
+@output("json", ".json", "application/json")
+def series(fig, chart, outf):
+    outf.write(json.dumps({
+        "chart": chart.name,
+        "axes": [plotted(ax) for ax in fig.axes if ax.lines or meshes(ax)],
+    }).encode())
+
+def meshes(ax):
+    return [c for c in ax.collections
+            if c.get_array() is not None and np.ndim(c.get_array()) == 2]
+
+def plotted(ax):
+    result = {
+        "title": ax.get_title(),
+        "xlabel": ax.get_xlabel(),
+        "ylabel": ax.get_ylabel(),
+    }
+    if ax.lines:
+        result["lines"] = [{
+            # Lines without a legend entry get labels like "_child0".
+            "label": None if line.get_label().startswith("_")
+                     else line.get_label(),
+            "x": jsonable(np.asarray(line.get_xdata())),
+            "y": jsonable(np.asarray(line.get_ydata())),
+        } for line in ax.lines]
+    for mesh in meshes(ax):
+        # A heatmap's cells, with rows and columns as labeled on its axes.
+        result["heatmap"] = {
+            "rows": [t.get_text() for t in ax.get_yticklabels()],
+            "columns": [t.get_text() for t in ax.get_xticklabels()],
+            "values": jsonable(np.ma.filled(
+                np.ma.asarray(mesh.get_array(), dtype=float), np.nan)),
+        }
+    return result
+
+# Lists for json.dumps, with NaN as null.
+def jsonable(values):
+    values = values.tolist() if hasattr(values, "tolist") else values
+    if isinstance(values, list):
+        return [jsonable(v) for v in values]
+    if isinstance(values, float) and math.isnan(values):
+        return None
+    return values
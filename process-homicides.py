@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict, Counter
-
 # cdc-homicides.txt
 # From CDC Wonder
 # https://wonder.cdc.gov/ucd-icd10.html
@@ -50,546 +48,312 @@ from collections import defaultdict, Counter
 #
 # Export results: yes
 
-def unquote(x):
-    if x.startswith('"') and x.endswith('"'):
-        return x[1:-1].strip()
-    return x
-
-years = set()
-ages = set()
-genders = set()
-groups = set()
-
-# (year, age, gender, group) -> deaths
-data = Counter()
-
-def to_group(records, cols):
-    is_hispanic = records[
-        cols.index("Hispanic Origin")] == "Hispanic or Latino"
-
-    race = {
-        "White": "White",
-        "Black or African American": "Black",
-    }.get(records[cols.index("Race")], "Other")
-
-    return "Hispanic" if is_hispanic else race
-    
-#return "Hispanic" if is_hispanic else race
-
-
-with open("cdc-homicides.txt") as inf:
-    for i, line in enumerate(inf):
-        records = [unquote(x) for x in line[:-1].split("\t")]
-        if i == 0:
-            cols = records
-            continue
-        if len(records) != len(cols): continue
-        year = int(records[cols.index("Year")])
-        years.add(year)
-        age_code = records[cols.index("Single-Year Ages Code")]
-        if age_code == "NS": continue
-        age = int(age_code)
-        ages.add(age)
-        deaths = int(records[cols.index("Deaths")])
-        gender = records[cols.index("Gender")]
-        genders.add(gender)
-        group = to_group(records, cols)
-        groups.add(group)
-        data[year, age, gender, group] = deaths
+import numpy as np
 
-# (year, age, gender, group) -> population
-populations = Counter()
+import charts
+import rates
+import strata
+import wonder
 
-# (year, age, gender, group) -> all_cause_deaths
-all_cause_deaths = Counter()
-
-for fname, gender in [
-        ("cdc-all-deaths-race-female.txt", "Female"),
-        ("cdc-all-deaths-race-male.txt", "Male")]:
-    with open(fname) as inf:
-        for i, line in enumerate(inf):
-            records = [unquote(x) for x in line[:-1].split("\t")]
-            if i == 0:
-                cols = records
-                continue
-            if len(records)!= len(cols): continue
-            if line.startswith('"Total"'): continue
-
-            year = int(records[cols.index("Year")])
-            age_code = records[cols.index("Single-Year Ages Code")]
-            if age_code == "NS": continue
-            age = int(age_code)
-            population_raw = records[cols.index("Population")]
-            if population_raw == 'Not Applicable': continue
-            population = int(population_raw)
-
-            ac_deaths_raw = records[cols.index("Deaths")]
-            ac_deaths = int(ac_deaths_raw)
-
-            group = to_group(records, cols)
-
-            all_cause_deaths[year, age, gender, group] = ac_deaths
-
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
-
-fig, ax = plt.subplots(constrained_layout=True)
-for gender in sorted(genders):
-    xs = []
-    ys = []
-    for age in sorted(ages):
-        total_deaths = 0
-        total_people = 0
-        for year in sorted(years):
-            for group in sorted(groups):
-                total_deaths += data[year, age, gender, group]
-                total_people += populations[year, age, gender, group]
-
-        if not total_people:
-            continue
-
-        xs.append(age)
-        ys.append(total_deaths * 100000 / total_people)
-    ax.plot(xs, ys, label=gender)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Firearm homicides by age and gender, 1999-2020")
-fig.savefig("firearm-homicides-by-age-and-gender-big.png")
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-for group in sorted(groups):
-    xs = []
-    ys = []
-    for age in sorted(ages):
-        total_deaths = 0
-        total_people = 0
-        for year in sorted(years):
-            for gender in sorted(genders):
-                total_deaths += data[year, age, gender, group]
-                total_people += populations[year, age, gender, group]
-
-        if not total_people:
-            continue
-
-        xs.append(age)
-        ys.append(total_deaths * 100000 / total_people)
-    ax.plot(xs, ys, label=group)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Firearm homicides by age and race/ethnicity, 1999-2020")
-fig.savefig("firearm-homicides-by-age-and-race-big.png")
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-for gender_groups in [
-        ["Male", "Black"],
-        ["Male", "White"],
-        ["Male", "Hispanic"],
-        ["Female", "Black"],
-        [["Male", "Other"],
-         ["Female", "Other"],
-         ["Female", "White"],
-         ["Female", "Hispanic"]]]:
-
-    if type(gender_groups[0]) != type([]):
-        gender_groups = [gender_groups]
-
-    xs = []
-    ys = []
-    for year in sorted(years):
-        total_deaths = 0
-        total_people = 0
-
-        for gender, group in gender_groups:
-            for age in sorted(ages):
-                total_deaths += data[year, age, gender, group]
-                total_people += populations[year, age, gender, group]
-
-        if not total_people:
-            continue
-
-        xs.append(year)
-        ys.append(total_deaths * 100000 / total_people)
-
-    if len(gender_groups) > 1:
-        label = "Other"
-    else:
-        (gender, group), = gender_groups
-        label = group + " " + gender;
-    ax.plot(xs, ys, label=label)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("year")
-ax.set_title("Firearm homicide rate by victim gender and race/ethnicity")
-fig.savefig("firearm-homicide-rate-by-year-and-gender-and-race-big.png")
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-for gender_groups in [
-        ["Male", "Black"],
-        ["Male", "White"],
-        ["Male", "Hispanic"],
-        ["Female", "Black"],
-        ["Female", "White"],
-        [["Male", "Other"],
-         ["Female", "Other"],
-         ["Female", "Hispanic"]]]:
-
-    if type(gender_groups[0]) != type([]):
-        gender_groups = [gender_groups]
-
-    xs = []
-    ys = []
-    for year in sorted(years):
-        total_deaths = 0
-
-        for gender, group in gender_groups:
-            for age in sorted(ages):
-                total_deaths += data[year, age, gender, group]
-
-        if not total_people:
-            continue
-
-        xs.append(year)
-        ys.append(total_deaths)
-
-    if len(gender_groups) > 1:
-        label ="Other"
-    else:
-        (gender, group), = gender_groups
-        label = group + " " + gender;
-    ax.plot(xs, ys, label=label)
+plt = charts.Lazy("matplotlib.pyplot")
+mtick = charts.Lazy("matplotlib.ticker")
 
-ax.legend()
-ax.set_ylabel("firearm homicides")
-ax.set_xlabel("year")
-ax.set_title("Firearm homicides by victim gender and race/ethnicity")
-fig.savefig("firearm-homicides-by-year-and-gender-and-race-big.png")
-plt.clf()
+# Groupings, strata and some of the charts below come from strata.json.
+config = strata.Config()
 
-import numpy as np
-import seaborn as sns
-import pandas as pd
-
-frame = []
-for year in sorted(years):
-    row = []
-    for age in sorted(ages):
-        total_deaths = 0
-        total_population = 0
-        for gender in ["Male"]:
-            for group in ["Black"]:
-                total_deaths += data[year, age, gender, group]
-                total_population += populations[year, age, gender, group]
-        if total_population == 0:
-            row.append(float("NaN"))
-        else:
-            row.append(100000 * total_deaths/total_population)
-    frame.append(row)
+# (race, hispanic origin) -> Hispanic, White, Black or Other
+to_group = config.groupings["group"]
 
-fig, ax = plt.subplots(constrained_layout=True, figsize=(12,8))
+axes = ["year", "age", "gender", "group"]
 
-df = pd.DataFrame(frame, index=sorted(years), columns=sorted(ages))
+# WONDER gives no single-year populations from 85 on.
+populated_ages = (0, 84)
 
-heatmap = sns.heatmap(df, xticklabels=True, yticklabels=True, ax=ax)
-heatmap.set_title("Firearm homicide rate by age and year, black males")
-heatmap.figure.savefig("firearm-homicide-rate-by-year-and-age-black-males-big.png" , dpi=180)
-plt.clf()
+@charts.dataset("cdc-homicides.txt", strata.CONFIG)
+def labels():
+    homicides = wonder.read_export("cdc-homicides.txt")
+    return {
+        "year": homicides.distinct("year"),
+        "age": homicides.distinct("age"),
+        "gender": homicides.distinct("gender"),
+        "group": sorted(set(
+            to_group(race, hispanic_origin)
+            for race in homicides.levels["race"]
+            for hispanic_origin in homicides.levels["hispanic"])),
+    }
 
+# (year, age, gender, group) -> deaths
+@charts.dataset("cdc-homicides.txt", strata.CONFIG)
+def data(labels):
+    data = wonder.cube(axes, labels)
+    for chunk in wonder.read_export("cdc-homicides.txt").chunks():
+        data.add({
+            "year": chunk.column("year"),
+            "age": chunk.column("age"),
+            "gender": chunk.column("gender"),
+            "group": chunk.derive(to_group, *to_group.columns),
+        }, chunk.deaths)
+    wonder.require("cdc-homicides.txt", data, ["year", "gender", "group"])
+    return data
+
+# Rows of the all-deaths exports with a population, chunk by chunk, each as
+# its coordinates along axes.  There's one export per gender, without a
+# gender column of its own.
+def everyone_chunks():
+    for fname, gender in [
+            ("cdc-all-deaths-race-female.txt", "Female"),
+            ("cdc-all-deaths-race-male.txt", "Male")]:
+        for chunk in wonder.read_export(fname).chunks():
+            chunk = chunk.select(chunk.population != wonder.MISSING)
+            yield chunk, {
+                "year": chunk.column("year"),
+                "age": chunk.column("age"),
+                "gender": (np.zeros(len(chunk), dtype=np.int64), [gender]),
+                "group": chunk.derive(to_group, *to_group.columns),
+            }
 
-fig, ax = plt.subplots(constrained_layout=True)
-for target_ages in reversed([
-        (0, 12),13,14,15,16,17,18,(19,22)]):
+# (year, age, gender, group) -> population
+@charts.dataset("cdc-all-deaths-race-female.txt",
+                "cdc-all-deaths-race-male.txt", strata.CONFIG)
+def populations(labels):
+    populations = wonder.cube(axes, labels)
+    for chunk, coords in everyone_chunks():
+        populations.add(coords, chunk.population)
+    wonder.require("populations", populations, axes,
+                   {"age": populated_ages})
+    return populations
 
-    if type(target_ages) == type(42):
-        min_age = max_age = target_ages
-        label = target_ages
-    else:
-        min_age, max_age = target_ages
-        label = "%s-%s" % (min_age, max_age)
-
-    xs = []
-    ys = []
-    for year in sorted(years):
-        total_deaths = 0
-        total_people = 0
-        for age in range(min_age, max_age+1):
-            for gender in genders:
-                for group in groups:
-                    total_deaths += data[year, age, gender, group]
-                    total_people += populations[year, age, gender, group]
-        if total_people:
-            xs.append(year)
-            ys.append(100000 * total_deaths/total_people)
-            
-    ax.plot(xs, ys, label=label)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Youth firearm homicides by age, 1999-2020")
-fig.savefig("youth-firearm-homicides-by-age-big.png")
-plt.clf()
-
-
-fig, ax = plt.subplots(constrained_layout=True)
-for target_ages in reversed([
-        (0, 12),13,14,15,16,17,18,(19,22)]):
-
-    if type(target_ages) == type(42):
-        min_age = max_age = target_ages
-        label = target_ages
-    else:
-        min_age, max_age = target_ages
-        label = "%s-%s" % (min_age, max_age)
-
-    xs = []
-    ys = []
-    for year in sorted(years):
-        total_deaths = 0
-        total_people = 0
-        for age in range(min_age, max_age+1):
-            for gender in ["Male"]:
-                for group in ["Black"]:
-                    total_deaths += data[year, age, gender, group]
-                    total_people += populations[year, age, gender, group]
-        if total_people:
-            xs.append(year)
-            ys.append(100000 * total_deaths/total_people)
-            
-    ax.plot(xs, ys, label=label)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Youth firearm homicide rates by age, black male, 1999-2020")
-fig.savefig("youth-firearm-homicides-by-age-black-male-big.png")
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-for target_ages in reversed([
-        (0, 12),13,14,15,16,17,18,(19,22)]):
-
-    if type(target_ages) == type(42):
-        min_age = max_age = target_ages
-        label = target_ages
-    else:
-        min_age, max_age = target_ages
-        label = "%s-%s" % (min_age, max_age)
-
-    xs = []
-    ys = []
-    for year in sorted(years):
-        total_deaths = 0
-        total_people = 0
-        for age in range(min_age, max_age+1):
-            for gender in ["Male"]:
-                for group in ["Hispanic"]:
-                    total_deaths += data[year, age, gender, group]
-                    total_people += populations[year, age, gender, group]
-        if total_people:
-            xs.append(year)
-            ys.append(100000 * total_deaths/total_people)
-            
-    ax.plot(xs, ys, label=label)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Youth firearm homicide rates by age, hispanic male, 1999-2020")
-fig.savefig("youth-firearm-homicides-by-age-hispanic-male-big.png")
-plt.clf()
-
-
-fig, ax = plt.subplots(constrained_layout=True)
-for target_ages in reversed([
-        (0, 12),13,14,15,16,17,18,(19,22)]):
-
-    if type(target_ages) == type(42):
-        min_age = max_age = target_ages
-        label = target_ages
-    else:
-        min_age, max_age = target_ages
-        label = "%s-%s" % (min_age, max_age)
-
-    xs = []
-    ys = []
-    for year in sorted(years):
-        total_deaths = 0
-        total_people = 0
-        for age in range(min_age, max_age+1):
-            for gender in genders:
-                for group in groups:
-                    if gender == "Male" and group == "Black": continue
-                    if gender == "Male" and group == "Hispanic": continue
-
-                    
-                    total_deaths += data[year, age, gender, group]
-                    total_people += populations[year, age, gender, group]
-        if total_people:
-            xs.append(year)
-            ys.append(100000 * total_deaths/total_people)
-            
-    ax.plot(xs, ys, label=label)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Youth firearm homicide rates by age, others, 1999-2020")
-fig.savefig("youth-firearm-homicides-by-age-others-big.png")
-plt.clf()
-
-
-fig, ax = plt.subplots(constrained_layout=True)
-for gender_groups in [
-        ["Male", "Black"], 
-        ["Male", "Hispanic"],
-        ["Female", "Black"],
-        ["Male", "White"],
-        ["Female", "White"],
-        ["Female", "Hispanic"],
-        [["Male", "Other"],
-         ["Female", "Other"]]]:
-
-    if type(gender_groups[0]) != type([]):
-        gender_groups = [gender_groups]
-
-    xs = []
-    ys = []
-    for age in sorted(ages):
-        total_deaths = 0
-        total_people = 0
-        for year in sorted(years):
-            for gender, group in gender_groups:
-                total_deaths += data[year, age, gender, group]
-                total_people += populations[year, age, gender, group]
-        if total_people:
-            xs.append(age)
-            ys.append(100000 * total_deaths/total_people)
-
-    print(gender_groups, xs, ys)
-            
-    if len(gender_groups) > 1:
-        label ="Other"
-    else:
-        (gender, group), = gender_groups
-        label = group + " " + gender;
-            
-    ax.plot(xs, ys, label=label)
-
-ax.legend()
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Firearm homicide rate by age, race, and gender 1999-2020")
-fig.savefig("firearm-homicide-rate-by-age-and-race-and-gender-big.png", dpi=180)
-plt.clf()
-
-
-fig, ax = plt.subplots(constrained_layout=True)
-xs = []
-ys = []
-for age in sorted(ages):
-    total_deaths = 0
-    total_people = 0
-    for gender in sorted(genders):
-        for year in sorted(years):
-            for group in sorted(groups):
-                total_deaths += data[year, age, gender, group]
-                total_people += populations[year, age, gender, group]
-    if total_people:
-        xs.append(age)
-        ys.append(100000 * total_deaths/total_people)
-            
-ax.plot(xs, ys)
-
-ax.set_ylabel("firearm homicides per 100k")
-ax.set_xlabel("age")
-ax.set_title("Firearm homicide rate by age 1999-2020")
-fig.savefig("firearm-homicide-rate-by-age-big.png", dpi=180)
-plt.clf()
-
-
-fig, ax = plt.subplots(constrained_layout=True)
-xs = []
-ys = []
-for age in sorted(ages):
-    total_deaths = 0
-    total_ac_deaths = 0
-    for gender in sorted(genders):
-        for year in sorted(years):
-            for group in sorted(groups):
-                total_deaths += data[year, age, gender, group]
-                total_ac_deaths += all_cause_deaths[year, age, gender, group]
-    if total_ac_deaths:
-        xs.append(age)
-        ys.append(100*total_deaths/total_ac_deaths)
-            
-ax.plot(xs, ys)
-
-ax.set_ylabel("firearm homicides as a fraction of deaths")
-ax.set_xlabel("age")
-ax.yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
-ax.set_title("Firearm homicide death fraction age 1999-2020")
-fig.savefig("firearm-homicide-death-fraction-by-age-big.png", dpi=180)
-plt.clf()
-
-
-for age in sorted(ages):
-    total_deaths = 0
-    for year in sorted(years):
-        for gender in genders:
-            for group in groups:
-                total_deaths += data[year, age, gender, group]
-    print (age, total_deaths)
-
-    
-fig, ax = plt.subplots(constrained_layout=True)
-for gender_groups in [
-        ["Male", "Black"], 
-        ["Male", "Hispanic"],
-        ["Female", "Black"],
-        ["Male", "White"],
-        ["Female", "White"],
-        ["Female", "Hispanic"],
-        [["Male", "Other"],
-         ["Female", "Other"]]]:
-
-    if type(gender_groups[0]) != type([]):
-        gender_groups = [gender_groups]
-
-    xs = []
-    ys = []
-    for age in sorted(ages):
-        total_deaths = 0
-        total_ac_deaths = 0
-        for year in sorted(years):
-            for gender, group in gender_groups:
-                total_deaths += data[year, age, gender, group]
-                total_ac_deaths += all_cause_deaths[year, age, gender, group]
-        if total_ac_deaths:
-            xs.append(age)
-            ys.append(100*total_deaths/total_ac_deaths)
-
-    if len(gender_groups) > 1:
-        label ="Other"
+# (year, age, gender, group) -> all_cause_deaths
+@charts.dataset("cdc-all-deaths-race-female.txt",
+                "cdc-all-deaths-race-male.txt", strata.CONFIG)
+def all_cause_deaths(labels):
+    all_cause_deaths = wonder.cube(axes, labels)
+    for chunk, coords in everyone_chunks():
+        all_cause_deaths.add(coords, chunk.deaths)
+    wonder.require("all-cause deaths", all_cause_deaths, axes,
+                   {"age": populated_ages})
+    return all_cause_deaths
+
+@charts.chart("firearm-homicides-by-age-and-gender-big.png")
+def homicides_by_age_and_gender(data, populations):
+    fig, ax = plt.subplots(constrained_layout=True)
+    for gender in data.labels["gender"]:
+        charts.plot(ax, data, populations, strata={"gender": gender},
+                    by="age", label=gender)
+
+    ax.legend()
+    ax.set_ylabel("firearm homicides per 100k")
+    ax.set_xlabel("age")
+    ax.set_title("Firearm homicides by age and gender, 1999-2020")
+    return fig
+
+@charts.chart("firearm-homicides-by-age-and-race-big.png")
+def homicides_by_age_and_race(data, populations):
+    fig, ax = plt.subplots(constrained_layout=True)
+    for group in data.labels["group"]:
+        charts.plot(ax, data, populations, strata={"group": group},
+                    by="age", label=group)
+
+    ax.legend()
+    ax.set_ylabel("firearm homicides per 100k")
+    ax.set_xlabel("age")
+    ax.set_title("Firearm homicides by age and race/ethnicity, 1999-2020")
+    return fig
+
+# One line per stratum in spec["lines"], by spec["by"], of deaths per per
+# of denominator, or without one, of deaths.  Charts don't use this
+# directly but one of measures, by spec["measure"], each of which takes
+# only the datasets it needs.
+def lines(data, denominator, spec, per=100000, standard=None):
+    fig, ax = plt.subplots(constrained_layout=True)
+    for line in spec["lines"]:
+        selected = strata.compile(data, line["stratum"])
+        if denominator is None:
+            ax.plot(data.labels[spec["by"]],
+                    rates.total(data, selected, by=spec["by"]),
+                    label=line["label"])
+        else:
+            charts.plot(ax, data, denominator, strata=selected,
+                        by=spec["by"], per=per, standard=standard,
+                        label=line["label"])
+
+    ax.legend()
+    ax.set_ylabel(spec["ylabel"])
+    ax.set_xlabel(spec["xlabel"])
+    ax.set_title(spec["title"])
+    return fig
+
+# "measure": "crude" or "adjusted": rates, age-adjusted to the US 2000
+# standard population for "adjusted".
+def rate_lines(data, populations, spec):
+    return lines(data, populations, spec,
+                 standard=standards[spec.get("measure", "crude")])
+
+standards = {
+    "crude": None,
+    "adjusted": rates.US_2000,
+}
+
+# "measure": "totals": deaths.
+def total_lines(data, spec):
+    return lines(data, None, spec)
+
+# "measure": "fraction": the percentage of all deaths.
+def fraction_lines(data, all_cause_deaths, spec):
+    fig = lines(data, all_cause_deaths, spec, per=100)
+    fig.axes[0].yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
+    return fig
+
+measures = {
+    "crude": rate_lines,
+    "adjusted": rate_lines,
+    "totals": total_lines,
+    "fraction": fraction_lines,
+}
+
+# Youth rates by year, one line per age band, for spec["stratum"], or for
+# everyone.
+def youth(data, populations, spec):
+    fig, ax = plt.subplots(constrained_layout=True)
+    stratum = strata.compile(data, spec.get("stratum", {}))
+    for target_ages in reversed([
+            (0, 12),13,14,15,16,17,18,(19,22)]):
+
+        if type(target_ages) == type(42):
+            min_age = max_age = target_ages
+            label = target_ages
+        else:
+            min_age, max_age = target_ages
+            label = "%s-%s" % (min_age, max_age)
+
+        selected = dict(stratum, age=(min_age, max_age))
+        charts.plot(ax, data, populations, strata=selected, by="year",
+                    label=label)
+
+    ax.legend()
+    ax.set_ylabel("firearm homicides per 100k")
+    ax.set_xlabel("age")
+    ax.set_title(spec["title"])
+    return fig
+
+# Heatmap of rates by year and age for spec["stratum"].
+def heatmap(data, populations, spec):
+    import seaborn as sns
+
+    (years, ages), frame = rates.rate(
+        data, populations, strata=strata.compile(data, spec["stratum"]),
+        by=("year", "age"))
+
+    fig, ax = plt.subplots(constrained_layout=True,
+                           figsize=spec.get("figsize"))
+    sns.heatmap(frame, xticklabels=ages.tolist(), yticklabels=years.tolist(),
+                ax=ax)
+    ax.set_title(spec["title"])
+    return fig
+
+# Heatmaps of rates by year and age, one for each pair of labels along
+# spec["rows"] and spec["columns"], on a shared scale.  Every panel's rates
+# come out of a single reduction.
+def heatmap_grid(data, populations, spec):
+    (rows, columns, years, ages), frames = rates.rate(
+        data, populations,
+        strata=strata.compile(data, spec.get("stratum", {})),
+        by=(spec["rows"], spec["columns"], "year", "age"))
+
+    fig, axs = plt.subplots(len(rows), len(columns), squeeze=False,
+                            sharex=True, sharey=True, constrained_layout=True,
+                            figsize=spec.get("figsize"))
+    highest = np.nanmax(frames) if np.isfinite(frames).any() else 1
+    for i, row in enumerate(rows):
+        for j, column in enumerate(columns):
+            ax = axs[i][j]
+            mesh = ax.pcolormesh(ages, years,
+                                 np.ma.masked_invalid(frames[i, j]),
+                                 vmin=0, vmax=highest, shading="nearest")
+            ax.set_title("%s %s" % (column, row))
+    axs[0][0].invert_yaxis()
+    axs[0][0].yaxis.set_major_locator(mtick.MaxNLocator(integer=True))
+    for ax in axs[-1]:
+        ax.set_xlabel("age")
+    for ax in axs[:, 0]:
+        ax.set_ylabel("year")
+    fig.colorbar(mesh, ax=axs, label="firearm homicides per 100k")
+    fig.suptitle(spec["title"])
+    return fig
+
+# The charts strata.json lists, by kind, or for lines, by measure.
+kinds = {
+    "youth": youth,
+    "heatmap": heatmap,
+    "heatmap-grid": heatmap_grid,
+}
+
+for spec in config.charts:
+    spec = dict(spec)
+    if "stratum" in spec:
+        spec["stratum"] = config.stratum(spec["stratum"])
+    if "lines" in spec:
+        spec["lines"] = [dict(line, stratum=config.stratum(line["stratum"]))
+                         for line in spec["lines"]]
+    if spec["kind"] == "lines":
+        draw = measures[spec.get("measure", "crude")]
     else:
-        (gender, group), = gender_groups
-        label = group + " " + gender;
-            
-    ax.plot(xs, ys, label=label)
-
-ax.legend()
-ax.set_ylabel("firearm homicides as a fraction of deaths")
-ax.set_xlabel("age")
-ax.yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
-ax.set_title("Firearm homicide death fraction by age, race, and gender 1999-2020")
-fig.savefig("firearm-homicide-death-fraction-rate-by-age-and-race-and-gender-big.png", dpi=180)
-plt.clf()
-
-
+        draw = kinds[spec["kind"]]
+    charts.chart(spec["output"], spec=spec, **spec.get("savefig", {}))(draw)
+
+@charts.chart("firearm-homicide-rate-by-age-big.png", dpi=180)
+def homicide_rate_by_age(data, populations):
+    fig, ax = plt.subplots(constrained_layout=True)
+    charts.plot(ax, data, populations, by="age")
+
+    ax.set_ylabel("firearm homicides per 100k")
+    ax.set_xlabel("age")
+    ax.set_title("Firearm homicide rate by age 1999-2020")
+    return fig
+
+@charts.chart("firearm-homicide-death-fraction-by-age-big.png", dpi=180)
+def homicide_death_fraction_by_age(data, all_cause_deaths):
+    fig, ax = plt.subplots(constrained_layout=True)
+    charts.plot(ax, data, all_cause_deaths, by="age", per=100)
+
+    ax.set_ylabel("firearm homicides as a fraction of deaths")
+    ax.set_xlabel("age")
+    ax.yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
+    ax.set_title("Firearm homicide death fraction age 1999-2020")
+    return fig
+
+@charts.table("homicides-by-age")
+def homicides_by_age(data):
+    return [{"age": age, "deaths": total_deaths}
+            for age, total_deaths in zip(
+                    data.labels["age"],
+                    rates.total(data, by="age").tolist())]
+
+# The rates firearm-homicide-rate-by-age-and-race-and-gender-big.png draws,
+# line by line.
+@charts.table("homicide-rate-by-age-and-race-and-gender")
+def homicide_rate_by_age_and_race_and_gender(data, populations):
+    spec = charts.CHARTS[
+        "firearm-homicide-rate-by-age-and-race-and-gender-big"].spec
+    rows = []
+    for line in spec["lines"]:
+        xs, ys = rates.rate(data, populations,
+                            strata=strata.compile(data, line["stratum"]),
+                            by="age")
+        rows.extend({"line": line["label"], "age": age, "rate": rate}
+                    for age, rate in zip(xs.tolist(), ys.tolist()))
+    return rows
+
+# Deaths, population and rate by year, age, gender and group, for
+# materialize.py.
+@charts.table("homicide-rates-by-gender-and-group")
+def homicide_rates_by_gender_and_group(data, populations):
+    return rates.rows(data, populations, by=axes)
+
+if __name__ == "__main__":
+    if charts.main():
+        for row in homicides_by_age(charts.load(data)):
+            print (row["age"], row["deaths"])
+        for row in homicide_rate_by_age_and_race_and_gender(
+                charts.load(data), charts.load(populations)):
+            print (row["line"], row["age"], row["rate"])
@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
 
-from collections import defaultdict, Counter
-
 # cdc.txt
 # From CDC Wonder
 # https://wonder.cdc.gov/ucd-icd10.html
@@ -44,6 +42,19 @@ causes_homicide = ["X93", "X94", "X95"]
 causes_undetermined = ["Y22", "Y23", "Y24"]
 causes_justified = ["Y35"]
 
+motives = [
+    ["homicide", causes_homicide],
+    ["suicide", causes_suicide],
+    ["unintentional, undetermined, or legal",
+     causes_unintentional + causes_undetermined + causes_justified],
+]
+
+gun_types = [
+    ["handgun", causes_handgun],
+    ["long gun", causes_longgun],
+    ["unspecified gun", causes_othergun],
+]
+
 # cdc-homicides.txt
 # From CDC Wonder
 # https://wonder.cdc.gov/ucd-icd10.html
@@ -77,273 +88,269 @@ causes_justified = ["Y35"]
 #
 # Export results: yes
 
-def unquote(x):
-    if x.startswith('"') and x.endswith('"'):
-        return x[1:-1].strip()
-    return x
-
-# year -> age -> cause -> [deaths, % of total deaths]
-data = defaultdict(lambda: defaultdict(Counter))
-total_firearm_deaths = 0
-with open("cdc.tsv") as inf:
-    for i, line in enumerate(inf):
-        records = [unquote(x) for x in line[:-1].split("\t")]
-        if i == 0:
-            cols = records
-            continue
-        if len(records) != len(cols): continue
-        year = int(records[cols.index("Year")])
-        age_code = records[cols.index("Single-Year Ages Code")]
-        if age_code == "NS": continue
-        age = int(age_code)
-        cause = records[cols.index("Cause of death Code")]
-        deaths = int(records[cols.index("Deaths")])
-
-        data[year][age][cause] = deaths
-        total_firearm_deaths += deaths
-
-# year -> age -> pop
-pops = defaultdict(Counter)
-
-# year -> age -> all deaths
-all_deaths = defaultdict(Counter)
-ages = set()
-with open("cdc-all-deaths.txt") as inf:
-    for i, line in enumerate(inf):
-        records = [unquote(x) for x in line[:-1].split("\t")]
-        if i == 0:
-            cols = records
-            continue
-        if len(records)!= len(cols): continue
-        if line.startswith('"Total"'): continue
-        
-        year = int(records[cols.index("Year")])
-        age_code = records[cols.index("Single-Year Ages Code")]
-        if age_code == "NS": continue
-        age = int(age_code)
-        ages.add(age)
-        population_raw = records[cols.index("Population")]
-        if population_raw == 'Not Applicable':
-            continue
-        population = int(population_raw)
-        deaths = int(records[cols.index("Deaths")])
-
-        pops[year][age] = population
-        all_deaths[year][age] = deaths
-
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
-
-fig, ax = plt.subplots(constrained_layout=True)
-
-xs = sorted(data)
-for min_age, max_age in [
-        (0, 8), (9,12), (13,17), (18,25),(26,max(ages))]:
-    ys = []
-    for year in xs:
-        total_deaths = 0
-        total_people = 0
-        for age in range(min_age, max_age+1):
-            for cause in data[year][age]:
-                deaths = data[year][age][cause]
-                total_deaths += deaths
-            total_people += pops[year][age]
-
-        deaths_per_100k = total_deaths * 100000 / total_people
-        ys.append(deaths_per_100k)
-
-    ax.plot(xs, ys, label="%s-%s" % (min_age, max_age))
-
-ax.legend()
-ax.set_ylabel("firearms deaths per 100k")
-ax.set_xlabel("year")
-ax.set_title("Firearms deaths by age over time")
-
-fig.savefig("firearms-deaths-by-age-over-time-big.png")
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-xs = []
-ys = []
-for age in sorted(ages):
-    total_deaths = 0
-    total_people = 0
-    for year in data:
-        for cause in data[year][age]:
-            deaths = data[year][age][cause]
-            total_deaths += deaths
-        total_people += pops[year][age]
-
-    if not total_people:
-        continue
-        
-    xs.append(age)
-    ys.append(total_deaths * 100000 / total_people)
-
-ax.plot(xs, ys)
-ax.set_ylabel("firearms deaths per 100k")
-ax.set_xlabel("age")
-ax.set_title("Firearms deaths by age, 1999-2020")
-fig.savefig("firearms-deaths-by-age-big.png")
-
-fig, ax = plt.subplots(constrained_layout=True)
-xs = []
-ys = []
-for age in sorted(ages):
-    total_gun_deaths = 0
-    total_deaths = 0
-    for year in data:
-        for cause in data[year][age]:
-            deaths = data[year][age][cause]
-            total_gun_deaths += deaths
-        total_deaths += all_deaths[year][age]
-
-    if not total_deaths:
-        continue
-        
-    xs.append(age)
-    ys.append(100 * total_gun_deaths / total_deaths)
-ax.yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
-ax.plot(xs, ys)
-ax.set_ylabel("Fraction of deaths from firearms")
-ax.set_xlabel("age")
-ax.set_title("Proportion of deaths from firearms by age, 1999-2020")
-fig.savefig("firearms-death-proportion-by-age-big.png")
-
-
-fig, ax = plt.subplots(constrained_layout=True)
-for gun_type, causes in [
-        ["handgun", causes_handgun],
-        ["long gun", causes_longgun],
-        ["unspecified gun", causes_othergun],
-]:
-    xs = []
-    ys = []
-    for age in sorted(ages):
-        total_deaths = 0
-        total_people = 0
-        for year in data:
-            for cause in data[year][age]:
-                if cause not in causes: continue
-                deaths = data[year][age][cause]
-                total_deaths += deaths
-            total_people += pops[year][age]
-
-        if not total_people:
-            continue
-        
-        xs.append(age)
-        ys.append(total_deaths * 100000 / total_people)
-
-    ax.plot(xs, ys, label=gun_type)
-ax.legend()
-ax.set_ylabel("firearms deaths per 100k")
-ax.set_xlabel("age")
-ax.set_title("Firearms deaths by age and gun type, 1999-2020")
-fig.savefig("firearms-deaths-by-age-and-gun-type-big.png")
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-motive_deaths = {}
-for motive, causes in [
-        ["homicide", causes_homicide],
-        ["suicide", causes_suicide],
-        ["unintentional, undetermined, or legal",
-         causes_unintentional + causes_undetermined + causes_justified],
-]:
-    motive_deaths[motive] = 0
-    xs = []
-    ys = []
-    for age in sorted(ages):
-        total_deaths = 0
-        total_people = 0
-        for year in data:
-            for cause in data[year][age]:
-                if cause not in causes: continue
-                deaths = data[year][age][cause]
-                total_deaths += deaths
-            total_people += pops[year][age]
-
-        motive_deaths[motive] += total_deaths
-
-        
-        if not total_people:
-            continue
-
-        if motive == "suicide":
-            print (age, total_deaths * 100000 / total_people)
-        
-        xs.append(age)
-        ys.append(total_deaths * 100000 / total_people)
-
-    ax.plot(xs, ys, label=motive)
-ax.legend()
-ax.set_ylabel("firearms deaths per 100k")
-ax.set_xlabel("age")
-ax.set_title("Firearms deaths by age and motive, 1999-2020")
-fig.savefig("firearms-deaths-by-age-and-motive-big.png")
-print(motive_deaths)
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-for motive, causes in [
-        ["homicide", causes_homicide],
-        ["suicide", causes_suicide],
-        ["other", causes_unintentional + causes_undetermined + causes_justified],
-]:
-    xs = []
-    ys = []
-    for age in sorted(ages):
-        total_gun_deaths = 0
-        total_deaths = 0
-        for year in data:
-            for cause in data[year][age]:
-                if cause not in causes: continue
-                deaths = data[year][age][cause]
-                total_gun_deaths += deaths
-            total_deaths += all_deaths[year][age]
-
-        if not total_deaths:
-            continue
-        
-        xs.append(age)
-        ys.append(100 * total_gun_deaths / total_deaths)
-
-    ax.plot(xs, ys, label=motive)
-ax.legend()
-ax.yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
-ax.set_xlabel("age")
-ax.set_title("Proportion of deaths from firearms by age and motive, 1999-2020")
-fig.savefig("firearms-deaths-proportion-by-age-and-motive-big.png")
-plt.clf()
-
-fig, ax = plt.subplots(constrained_layout=True)
-
-xs = sorted(data)
-for age in range(75):
-    ys = []
-    use_xs = []
-    for year in xs:
-        total_deaths = 0
-        total_people = 0
-        for cause in data[year][age]:
-            deaths = data[year][age][cause]
-            total_deaths += deaths
-        total_people = pops[year][age]
-        if not total_people: continue
-        
-        deaths_per_100k = total_deaths * 100000 / total_people
-        ys.append(deaths_per_100k)
-        use_xs.append(year)
-
-    ax.plot(use_xs, ys, label="%s" % age)
-
-ax.legend()
-ax.set_ylabel("firearms deaths per 100k")
-ax.set_xlabel("year")
-ax.set_title("Firearms deaths by age over time")
-fig.savefig("firearms-deaths-by-age-over-time-fine-big.png")
-plt.clf()
-
-
-            
+import os
+import sys
+
+import numpy as np
+
+import charts
+import rates
+import wonder
+
+plt = charts.Lazy("matplotlib.pyplot")
+mtick = charts.Lazy("matplotlib.ticker")
+
+# The export populations come from.  By default that's cdc-all-deaths.txt,
+# and the Population and Crude Rate columns of cdc.tsv are checked against
+# it as they're read.  With POPULATIONS=cdc.tsv, they come from cdc.tsv
+# alone, so that charts of firearm deaths only read the one export.
+# cdc.tsv only has rows where there were firearm deaths, though, so a
+# year, age and gender without any has no population there.  Rates that
+# take in any of those, like an age band in a year where one age had no
+# firearm deaths, are left undefined rather than too high; how many there
+# are is printed.
+POPULATIONS = os.environ.get("POPULATIONS", "cdc-all-deaths.txt")
+
+@charts.dataset("cdc.tsv", POPULATIONS)
+def labels():
+    firearm = wonder.read_export("cdc.tsv")
+    everyone = wonder.read_export(POPULATIONS)
+    return {
+        "year": firearm.distinct("year"),
+        "age": everyone.distinct("age"),
+        "cause": firearm.distinct("cause"),
+    }
+
+# (year, age, cause) -> deaths
+@charts.dataset("cdc.tsv")
+def data(labels):
+    data = wonder.cube(["year", "age", "cause"], labels)
+    for chunk in wonder.read_export("cdc.tsv").chunks():
+        data.add({
+            "year": chunk.column("year"),
+            "age": chunk.column("age"),
+            "cause": chunk.column("cause"),
+        }, chunk.deaths)
+    wonder.require("cdc.tsv", data, ["year"])
+    return data
+
+# WONDER gives no single-year populations from 85 on.
+populated_ages = (0, 84)
+
+# Rows of cdc-all-deaths.txt with a population, chunk by chunk.
+def everyone_chunks():
+    for chunk in wonder.read_export("cdc-all-deaths.txt").chunks():
+        yield chunk.select(chunk.population != wonder.MISSING)
+
+# (year, age) -> pop, or from cdc.tsv, (year, age, gender) -> pop, which
+# rates sum over gender like any other axis.
+@charts.dataset("cdc.tsv", POPULATIONS)
+def pops(labels, firearm_pops):
+    if POPULATIONS == "cdc.tsv":
+        report_gaps(firearm_pops)
+        return firearm_pops
+
+    pops = wonder.cube(["year", "age"], labels)
+    for chunk in everyone_chunks():
+        pops.add({"year": chunk.column("year"), "age": chunk.column("age")},
+                 chunk.population)
+    wonder.require("populations", pops, ["year", "age"],
+                   {"age": populated_ages})
+    check_pops(firearm_pops, pops)
+    return pops
+
+# (year, age, gender) -> pop from the Population column of cdc.tsv, which
+# repeats it on the row for each cause.  Cells without a row are zero, and
+# up to populated_ages, marked in its gaps.  Checks the Crude Rate column
+# on the way.
+@charts.dataset("cdc.tsv")
+def firearm_pops(labels):
+    firearm = wonder.read_export("cdc.tsv")
+    pops = wonder.cube(["year", "age", "gender"],
+                       dict(labels, gender=firearm.distinct("gender")))
+    wrong = 0
+    for chunk in firearm.chunks():
+        chunk = chunk.select(chunk.population != wonder.MISSING)
+        pops.put({
+            "year": chunk.column("year"),
+            "age": chunk.column("age"),
+            "gender": chunk.column("gender"),
+        }, chunk.population)
+
+        # WONDER rounds rates to a tenth.
+        rated = ~np.isnan(chunk.crude_rate)
+        expected = chunk.deaths[rated] * 100000 / chunk.population[rated]
+        wrong += np.count_nonzero(
+            np.abs(expected - chunk.crude_rate[rated]) > 0.05 + 1e-9)
+    if wrong:
+        print("cdc.tsv: %s rows have a Crude Rate that isn't Deaths per 100k "
+              "of Population" % wrong, file=sys.stderr)
+
+    axes = ["year", "age", "gender"]
+    missing = ~pops.occupied(axes)
+    missing &= rates.keep(pops.labels["age"], populated_ages)[None, :, None]
+    cells = np.nonzero(missing)
+    pops.gaps = wonder.cube(axes, pops.labels)
+    pops.gaps.put({
+        "year": np.asarray(pops.labels["year"])[cells[0]],
+        "age": np.asarray(pops.labels["age"])[cells[1]],
+        "gender": (cells[2], pops.labels["gender"]),
+    }, np.ones(len(cells[0]), dtype=np.int64))
+    return pops
+
+# Reports the years, ages and genders firearm's gaps mark.
+def report_gaps(firearm):
+    cells = ["%s age %s %s" % tuple(
+        firearm.labels[axis][i] for axis, i in zip(firearm.axes, cell))
+             for cell in zip(*np.nonzero(firearm.gaps.occupied(firearm.axes)))]
+    if cells:
+        print("cdc.tsv: no population for %s years, ages and genders, so "
+              "rates taking any of them in are undefined: %s%s" % (
+                  len(cells), ", ".join(cells[:10]),
+                  ", ..." if len(cells) > 10 else ""),
+              file=sys.stderr)
+
+# Checks that cdc.tsv's populations, where it has every gender, add up to
+# cdc-all-deaths.txt's.
+def check_pops(firearm, pops):
+    complete = firearm.occupied(["year", "age", "gender"]).all(axis=2)
+    theirs = rates.total(firearm, by=("year", "age"))
+    ours = rates.total(pops, by=("year", "age"))
+    for y, a in zip(*np.nonzero(complete & (theirs != ours))):
+        print("cdc.tsv: population for %s age %s is %s, but %s in "
+              "cdc-all-deaths.txt" % (
+                  pops.labels["year"][y], pops.labels["age"][a],
+                  theirs[y, a], ours[y, a]),
+              file=sys.stderr)
+
+# (year, age) -> all deaths
+@charts.dataset("cdc-all-deaths.txt")
+def all_deaths(labels):
+    all_deaths = wonder.cube(["year", "age"], labels)
+    for chunk in everyone_chunks():
+        all_deaths.add(
+            {"year": chunk.column("year"), "age": chunk.column("age")},
+            chunk.deaths)
+    wonder.require("all deaths", all_deaths, ["year", "age"],
+                   {"age": populated_ages})
+    return all_deaths
+
+@charts.chart("firearms-deaths-by-age-over-time-big.png")
+def deaths_by_age_over_time(data, pops):
+    fig, ax = plt.subplots(constrained_layout=True)
+
+    for min_age, max_age in [
+            (0, 8), (9,12), (13,17), (18,25),(26,max(data.labels["age"]))]:
+        charts.plot(ax, data, pops, strata={"age": (min_age, max_age)},
+                    by="year", label="%s-%s" % (min_age, max_age))
+
+    ax.legend()
+    ax.set_ylabel("firearms deaths per 100k")
+    ax.set_xlabel("year")
+    ax.set_title("Firearms deaths by age over time")
+    return fig
+
+@charts.chart("firearms-deaths-by-age-big.png")
+def deaths_by_age(data, pops):
+    fig, ax = plt.subplots(constrained_layout=True)
+    charts.plot(ax, data, pops, by="age")
+    ax.set_ylabel("firearms deaths per 100k")
+    ax.set_xlabel("age")
+    ax.set_title("Firearms deaths by age, 1999-2020")
+    return fig
+
+@charts.chart("firearms-death-proportion-by-age-big.png")
+def death_proportion_by_age(data, all_deaths):
+    fig, ax = plt.subplots(constrained_layout=True)
+    ax.yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
+    charts.plot(ax, data, all_deaths, by="age", per=100)
+    ax.set_ylabel("Fraction of deaths from firearms")
+    ax.set_xlabel("age")
+    ax.set_title("Proportion of deaths from firearms by age, 1999-2020")
+    return fig
+
+@charts.chart("firearms-deaths-by-age-and-gun-type-big.png")
+def deaths_by_age_and_gun_type(data, pops):
+    fig, ax = plt.subplots(constrained_layout=True)
+    for gun_type, causes in gun_types:
+        charts.plot(ax, data, pops, causes, by="age", label=gun_type)
+    ax.legend()
+    ax.set_ylabel("firearms deaths per 100k")
+    ax.set_xlabel("age")
+    ax.set_title("Firearms deaths by age and gun type, 1999-2020")
+    return fig
+
+@charts.chart("firearms-deaths-by-age-and-motive-big.png")
+def deaths_by_age_and_motive(data, pops):
+    fig, ax = plt.subplots(constrained_layout=True)
+    for motive, causes in motives:
+        charts.plot(ax, data, pops, causes, by="age", label=motive)
+    ax.legend()
+    ax.set_ylabel("firearms deaths per 100k")
+    ax.set_xlabel("age")
+    ax.set_title("Firearms deaths by age and motive, 1999-2020")
+    return fig
+
+@charts.chart("firearms-deaths-proportion-by-age-and-motive-big.png")
+def deaths_proportion_by_age_and_motive(data, all_deaths):
+    fig, ax = plt.subplots(constrained_layout=True)
+    # This chart has always called the last motive "other".
+    short = {motives[-1][0]: "other"}
+    for motive, causes in motives:
+        charts.plot(ax, data, all_deaths, causes, by="age", per=100,
+                    label=short.get(motive, motive))
+    ax.legend()
+    ax.yaxis.set_major_formatter(mtick.PercentFormatter(decimals=0))
+    ax.set_xlabel("age")
+    ax.set_title(
+        "Proportion of deaths from firearms by age and motive, 1999-2020")
+    return fig
+
+@charts.chart("firearms-deaths-by-age-over-time-fine-big.png")
+def deaths_by_age_over_time_fine(data, pops):
+    fig, ax = plt.subplots(constrained_layout=True)
+
+    for age in range(75):
+        charts.plot(ax, data, pops, strata={"age": age}, by="year",
+                    label="%s" % age)
+
+    ax.legend()
+    ax.set_ylabel("firearms deaths per 100k")
+    ax.set_xlabel("year")
+    ax.set_title("Firearms deaths by age over time")
+    return fig
+
+@charts.table("motive-deaths")
+def motive_deaths(data):
+    return [{"motive": motive,
+             "deaths": int(rates.total(data, {"cause": causes}))}
+            for motive, causes in motives]
+
+@charts.table("suicide-rate-by-age")
+def suicide_rate_by_age(data, pops):
+    xs, ys = rates.rate(data, pops, causes_suicide, by="age")
+    return [{"age": age, "rate": rate}
+            for age, rate in zip(xs.tolist(), ys.tolist())]
+
+# Deaths, population and rate by year and age, overall and broken out by
+# motive and by gun type, for materialize.py.
+@charts.table("rates-by-year-and-age")
+def rates_by_year_and_age(data, pops):
+    return rates.rows(data, pops, by=("year", "age"))
+
+@charts.table("rates-by-motive")
+def rates_by_motive(data, pops):
+    return [dict(motive=motive, **row) for motive, causes in motives
+            for row in rates.rows(data, pops, causes, by=("year", "age"))]
+
+@charts.table("rates-by-gun-type")
+def rates_by_gun_type(data, pops):
+    return [dict(gun_type=gun_type, **row) for gun_type, causes in gun_types
+            for row in rates.rows(data, pops, causes, by=("year", "age"))]
+
+if __name__ == "__main__":
+    if charts.main():
+        for row in suicide_rate_by_age(charts.load(data), charts.load(pops)):
+            print (row["age"], row["rate"])
+        print({row["motive"]: row["deaths"]
+               for row in motive_deaths(charts.load(data))})
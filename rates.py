@@ -0,0 +1,422 @@
+# Queries over the Cubes process.py and process-homicides.py load: totals,
+# rates per 100k, age-adjusted rates and fractions of deaths, for any
+# selection of strata, broken out by any axes.
+#
+# strata maps an axis to what to keep along it:
+#   a label                      "Male", 1999
+#   a list or set of labels      ["X93", "X94", "X95"]
+#   a (low, high) tuple          (13, 17), inclusive, for numeric axes
+#   a boolean mask over the axis
+# A tuple of axes selects on them jointly, with a list of label tuples or a
+# boolean mask over those axes:
+#   {("gender", "group"): [("Male", "Black"), ("Female", "Black")]}
+# Axes a cube doesn't have are ignored, so the same strata can be applied
+# to firearm deaths broken out by cause and to populations that aren't.
+#
+# by names the axis, or tuple of axes, to break the result out by; every
+# other axis is summed over.
+#
+# Totals are remembered in memo.cache, so charts breaking the same counts
+# out the same way share one pass over the cube.  They come back read-only.
+
+import itertools
+import math
+import statistics
+
+import numpy as np
+
+import memo
+
+# The positions along an axis with the given labels that selector keeps.
+def keep(labels, selector):
+    labels = np.asarray(labels)
+    if isinstance(selector, np.ndarray):
+        return selector
+    if isinstance(selector, tuple):
+        low, high = selector
+        return (labels >= low) & (labels <= high)
+    if isinstance(selector, (list, set, frozenset)):
+        return np.isin(labels, list(selector))
+    return labels == selector
+
+# Boolean mask over several axes keeping the given label tuples.
+def keep_jointly(labels, axes, selector):
+    if isinstance(selector, np.ndarray):
+        return selector
+    mask = np.zeros([len(labels[axis]) for axis in axes], dtype=bool)
+    for combo in selector:
+        mask[tuple(labels[axis].index(label)
+                   for axis, label in zip(axes, combo))] = True
+    return mask
+
+# Sums cube over the axes not in by, counting only cells in strata.
+# Returns the totals, indexed by the by axes in the order given.
+def total(cube, strata=None, by=()):
+    key = ("total", cube.version, memo.freeze(strata or {}), memo.freeze(by))
+    return memo.cache.get(key, lambda: aggregate(cube, strata, by))
+
+def aggregate(cube, strata, by):
+    if cube.sparse:
+        return aggregate_sparse(cube, strata, by)
+    by = [by] if isinstance(by, str) else list(by)
+    strata = dict(strata or {})
+    values = cube.values
+    axes = list(cube.axes)
+
+    # A range along an axis that's summed over anyway comes straight off
+    # the cube's prefix sums.
+    jointly = [a for axis in strata if not isinstance(axis, str) for a in axis]
+    for axis, selector in strata.items():
+        if (axis in axes and axis not in by and axis not in jointly
+                and isinstance(selector, tuple)):
+            values = cube.band(axis, *selector)
+            axes.remove(axis)
+            del strata[axis]
+            break
+
+    # Joint selections go first, while their axes are still full length.
+    for axis, selector in strata.items():
+        if isinstance(axis, str) or not all(a in axes for a in axis):
+            continue
+        mask = keep_jointly(cube.labels, axis, selector)
+        # Puts the mask's axes in the cube's order, with length one
+        # along the others, so it lines up with values.
+        order = [axes.index(a) for a in axis]
+        mask = np.transpose(mask, np.argsort(order))
+        shape = [1] * len(axes)
+        for a, size in zip(sorted(order), mask.shape):
+            shape[a] = size
+        values = values * mask.reshape(shape)
+
+    for axis, selector in strata.items():
+        if isinstance(axis, str) and axis in axes:
+            values = np.compress(keep(cube.labels[axis], selector), values,
+                                 axis=axes.index(axis))
+
+    values = values.sum(axis=tuple(
+        a for a, axis in enumerate(axes) if axis not in by))
+    remaining = [axis for axis in axes if axis in by]
+    values = np.transpose(
+        values, [remaining.index(axis) for axis in by if axis in remaining])
+    values = np.asarray(values)
+    values = values.reshape(broadcast_shape(cube, by, values.shape))
+    values.flags.writeable = False
+    return values
+
+# Along by axes that cube doesn't have, its totals are the same for every
+# label, as with strata on those axes, so they have length one there and
+# broadcast against totals that do have the axes.  This is shape, the
+# lengths along the by axes cube has, with those axes put back.
+def broadcast_shape(cube, by, shape):
+    sizes = iter(shape)
+    return [next(sizes) if axis in cube.axes else 1 for axis in by]
+
+# aggregate() for a SparseCube: the stored cells strata keep are grouped by
+# their positions along the by axes, so the work goes with the cells that
+# have something in them, and only the result is dense.
+def aggregate_sparse(cube, strata, by):
+    by = [by] if isinstance(by, str) else list(by)
+    strata = strata or {}
+    coords = cube.coords()
+    cells = np.ones(len(cube.keys), dtype=bool)
+    for axis, selector in strata.items():
+        if isinstance(axis, str):
+            if axis in cube.axes:
+                cells &= keep(cube.labels[axis],
+                              selector)[coords[cube.axis(axis)]]
+        elif all(a in cube.axes for a in axis):
+            mask = keep_jointly(cube.labels, axis, selector)
+            cells &= mask[tuple(coords[cube.axis(a)] for a in axis)]
+
+    present = [axis for axis in by if axis in cube.axes]
+    shape = [len(cube.labels[axis]) for axis in present]
+    flat = np.ravel_multi_index(
+        [coords[cube.axis(axis)][cells] for axis in present], shape) \
+        if present else np.zeros(np.count_nonzero(cells), dtype=np.int64)
+    values = np.bincount(flat, weights=cube.counts[cells],
+                         minlength=int(np.prod(shape))).astype(np.int64)
+    values = values.reshape(broadcast_shape(cube, by, shape))
+    for a, axis in enumerate(by):
+        if axis in strata and axis in cube.axes:
+            values = np.compress(keep(cube.labels[axis], strata[axis]),
+                                 values, axis=a)
+    values.flags.writeable = False
+    return values
+
+# The labels along each by axis that survive strata.
+def labels(cube, strata=None, by=()):
+    strata = strata or {}
+    result = []
+    for axis in [by] if isinstance(by, str) else by:
+        if axis not in cube.axes:
+            raise ValueError("can't break down by %s: the numerator has "
+                             "only %s" % (axis, ", ".join(cube.axes)))
+        axis_labels = np.array(cube.labels[axis])
+        if axis in strata:
+            axis_labels = axis_labels[keep(axis_labels, strata[axis])]
+        result.append(axis_labels)
+    return result
+
+# numerator * per / denominator over the by axes.  causes, if given, picks
+# the cause codes counted in the numerator.  The denominator needn't have
+# every by axis: populations have no cause, so rates by cause all divide
+# by the same population.
+#
+# With a single by axis, returns (xs, ys) for the positions where the
+# denominator isn't zero, ready to plot.  Otherwise returns a list of the
+# labels along each by axis and an array of rates, NaN where the
+# denominator is zero.
+def rate(numerator, denominator, causes=None, strata=None, by=(),
+         per=100000):
+    strata = dict(strata or {})
+    if causes is not None:
+        strata["cause"] = list(causes)
+
+    xs = labels(numerator, strata, by)
+    top = total(numerator, strata, by)
+    bottom = np.broadcast_to(total(denominator, strata, by), np.shape(top))
+
+    defined = (bottom != 0) & ~gaps(denominator, strata, by, np.shape(top))
+
+    if isinstance(by, str):
+        return xs[0][defined], top[defined] * per / bottom[defined]
+
+    ys = np.full(np.shape(top), float("NaN"))
+    np.divide(top * per, bottom, out=ys, where=defined)
+    return xs, ys
+
+# Where totals of denominator over strata and by take in a cell its gaps
+# cube marks as having no count, as a boolean array of the given shape.
+# Rates there would come out too high, so they're left undefined.
+def gaps(denominator, strata, by, shape):
+    if denominator.gaps is None:
+        return np.zeros(shape, dtype=bool)
+    return np.broadcast_to(total(denominator.gaps, strata, by) > 0, shape)
+
+# rate() as rows of {axis: label, ..., "deaths": ..., "population": ...,
+# "rate": ...}, one for every combination of labels along by, with None
+# where the rate is undefined.  names are the columns for the numerator and
+# denominator totals.
+def rows(numerator, denominator, causes=None, strata=None, by=(),
+         per=100000, names=("deaths", "population")):
+    by = [by] if isinstance(by, str) else list(by)
+    strata = select(causes, strata)
+    xs, ys = rate(numerator, denominator, strata=strata, by=by, per=per)
+    top = total(numerator, strata, by)
+    bottom = np.broadcast_to(total(denominator, strata, by), np.shape(top))
+    cells = itertools.product(*[x.tolist() for x in xs])
+    return [dict(zip(by, cell), **{
+        names[0]: t, names[1]: b, "rate": None if math.isnan(y) else y})
+            for cell, t, b, y in zip(cells, top.ravel().tolist(),
+                                     bottom.ravel().tolist(),
+                                     ys.ravel().tolist())]
+
+# Deaths as a percentage of all deaths, like rate().
+def fraction(deaths, all_deaths, causes=None, strata=None, by=()):
+    return rate(deaths, all_deaths, causes, strata, by, per=100)
+
+# The 2000 US standard population (Census P25-1130) in the 19 age groups
+# NCHS and WONDER age-adjust with, as ((low, high), population), ages
+# inclusive.
+US_2000 = [
+    ((0, 0), 3794901),
+    ((1, 4), 15191619),
+    ((5, 9), 19919840),
+    ((10, 14), 20056779),
+    ((15, 19), 19819518),
+    ((20, 24), 18257225),
+    ((25, 29), 17722067),
+    ((30, 34), 19511370),
+    ((35, 39), 22179956),
+    ((40, 44), 22479229),
+    ((45, 49), 19805793),
+    ((50, 54), 17224359),
+    ((55, 59), 13307234),
+    ((60, 64), 10654272),
+    ((65, 69), 9409940),
+    ((70, 74), 8725574),
+    ((75, 79), 7414559),
+    ((80, 84), 4900234),
+    ((85, 200), 4259173),
+]
+
+# Age-adjusted rates, like rate(), by direct standardization: the rate in
+# each of standard's age groups, weighted by the group's share of the
+# standard population.  Age groups with no population in a cell, like
+# those outside an age range in strata, are left out of its weights.
+#
+# Both cubes are totaled by the by axes and age at once, and the age
+# groups and weights applied along the last axis, so every cell of by is
+# adjusted in the same few array operations.
+def adjusted(numerator, denominator, causes=None, strata=None, by=(),
+             per=100000, standard=US_2000):
+    strata = select(causes, strata)
+    top, bottom, weights = grouped(numerator, denominator, strata, by,
+                                   standard)
+    ys = standardize(top, bottom, weights, per)
+    ys[gaps(denominator, strata, by, ys.shape)] = float("NaN")
+    return series(labels(numerator, strata, by), by, ys)
+
+# strata, plus causes as a selection on the cause axis.
+def select(causes, strata):
+    strata = dict(strata or {})
+    if causes is not None:
+        strata["cause"] = list(causes)
+    return strata
+
+# Totals of numerator and denominator by the by axes and then by standard's
+# age groups, along the last axis, with the standard population in each
+# group.  Without a standard, the last axis has one group, everyone.
+def grouped(numerator, denominator, strata, by, standard=None):
+    axes = [by] if isinstance(by, str) else list(by)
+    if standard is None:
+        top = total(numerator, strata, axes)[..., None]
+        bottom = total(denominator, strata, axes)[..., None]
+        return top, np.broadcast_to(bottom, top.shape), np.ones(1)
+    if "age" in axes:
+        raise ValueError("can't age-adjust a rate broken out by age")
+
+    top = total(numerator, strata, axes + ["age"])
+    bottom = np.broadcast_to(total(denominator, strata, axes + ["age"]),
+                             top.shape)
+    ages, = labels(numerator, strata, ["age"])
+
+    # Sums over each age group that has ages here, with the group's weight.
+    starts = np.searchsorted(ages, [low for (low, high), _ in standard])
+    ends = np.searchsorted(ages, [high for (low, high), _ in standard],
+                           side="right")
+    present = ends > starts
+    weights = np.array([w for _, w in standard], dtype=float)[present]
+    return (np.add.reduceat(top, starts[present], axis=-1),
+            np.add.reduceat(bottom, starts[present], axis=-1), weights)
+
+# How much each death in each age group adds to its cell's standardized
+# rate: the group's share of the weight over the groups with population
+# there, per head of the group.
+def death_weights(bottom, weights, per):
+    covered = bottom > 0
+    share = covered * weights
+    share = np.divide(share, share.sum(axis=-1, keepdims=True),
+                      out=np.zeros(share.shape), where=covered)
+    return np.divide(share * per, bottom, out=np.zeros(share.shape),
+                     where=covered)
+
+# Standardized rates from grouped() totals, NaN where no group has any
+# population.  top can have extra leading axes, as bootstrap samples do.
+def standardize(top, bottom, weights, per):
+    covered = bottom > 0
+    group_rates = np.divide(top * per, bottom,
+                            out=np.zeros(np.broadcast_shapes(
+                                np.shape(top), np.shape(bottom))),
+                            where=covered)
+    weight = (covered * weights).sum(axis=-1)
+    ys = np.full(group_rates.shape[:-1], float("NaN"))
+    np.divide((group_rates * weights).sum(axis=-1), weight, out=ys,
+              where=weight > 0)
+    return ys
+
+# What rate() returns, given the labels along by and the values, NaN where
+# undefined: with a single by axis, only the defined positions.
+def series(xs, by, *values):
+    if isinstance(by, str):
+        defined = ~np.isnan(values[0])
+        return (xs[0][defined],) + tuple(v[defined] for v in values)
+    return (xs,) + values
+
+# Confidence level for interval() and bootstrap.bands().
+LEVEL = 0.95
+
+# Confidence intervals for rate(), or with standard, for adjusted(), as
+# (low, high) lined up with what those return.
+#
+# These are the gamma intervals of Fay and Feuer, which NCHS uses for
+# age-adjusted rates.  For a crude rate they're the exact Poisson interval
+# on its deaths: zero deaths in a cell still give a nonzero upper bound.
+# The gamma quantiles are exact for the small shapes a handful of deaths
+# give and come from the Wilson-Hilferty approximation above that, so this
+# is a few passes of array arithmetic over every cell.
+def interval(numerator, denominator, causes=None, strata=None, by=(),
+             per=100000, standard=None, level=LEVEL):
+    strata = select(causes, strata)
+    top, bottom, weights = grouped(numerator, denominator, strata, by,
+                                   standard)
+    w = death_weights(bottom, weights, per)
+    ys = (w * top).sum(axis=-1)
+    variance = (w * w * top).sum(axis=-1)
+    most = w.max(axis=-1)
+
+    defined = bottom.sum(axis=-1) > 0
+    low = np.full(ys.shape, float("NaN"))
+    high = np.full(ys.shape, float("NaN"))
+    low[defined] = 0
+    some = variance > 0
+    low[some] = gamma_quantile((1 - level) / 2, ys[some] ** 2 /
+                               variance[some]) * variance[some] / ys[some]
+    high[defined] = gamma_quantile(
+        (1 + level) / 2,
+        (ys[defined] + most[defined]) ** 2 /
+        (variance[defined] + most[defined] ** 2)) * (
+        (variance[defined] + most[defined] ** 2) /
+        (ys[defined] + most[defined]))
+
+    missing = gaps(denominator, strata, by, low.shape)
+    low[missing] = high[missing] = float("NaN")
+    xs, low, high = series(labels(numerator, strata, by), by, low, high)
+    return low, high
+
+# Shapes below this get exact gamma quantiles.  Wilson-Hilferty is within
+# 1% from here on, but its lower quantiles are far too low below it: by
+# half at a shape of 1.
+EXACT_SHAPE = 10
+
+# Quantile p of the gamma distribution with the given shapes and unit
+# scale: by the Wilson-Hilferty approximation, or for shapes below
+# EXACT_SHAPE, by solving regularized_gamma(shape, x) = p for the log of x,
+# all shapes at once, with Newton steps that fall back on bisecting when
+# they'd leave the bracket the root is known to be in.
+def gamma_quantile(p, shape):
+    z = statistics.NormalDist().inv_cdf(p)
+    shape = np.asarray(shape, dtype=float)
+    third = np.divide(1, 9 * shape, out=np.zeros(shape.shape),
+                      where=shape > 0)
+    x = shape * np.maximum(1 - third + z * np.sqrt(third), 0) ** 3
+
+    small = (shape > 0) & (shape < EXACT_SHAPE)
+    if small.any():
+        a, cells = np.unique(shape[small], return_inverse=True)
+        lgamma = np.frompyfunc(math.lgamma, 1, 1)(a).astype(float)
+        low = np.full(a.shape, -700.0)
+        high = np.full(a.shape, math.log(EXACT_SHAPE + 40))
+        # Quantiles too small for a float are as good as zero.
+        high = np.where(regularized_gamma(a, np.exp(low)) < p, high, low)
+        u = np.minimum(np.log(a), high)
+        for i in range(100):
+            below = regularized_gamma(a, np.exp(u)) - p
+            done = (np.abs(below) < 1e-14) | (high - low < 1e-12)
+            if done.all():
+                break
+            low = np.where(below < 0, u, low)
+            high = np.where(below < 0, high, u)
+            # d/du of regularized_gamma(a, e^u)
+            slope = np.exp(a * u - np.exp(u) - lgamma)
+            with np.errstate(over="ignore"):
+                step = np.divide(-below, slope, out=np.full(u.shape, np.inf),
+                                 where=slope > 0)
+            u = np.where(done, u,
+                         np.where((u + step > low) & (u + step < high),
+                                  u + step, (low + high) / 2))
+        x[small] = np.exp(u)[cells.ravel()]
+    return x
+
+# The regularized lower incomplete gamma function P(a, x), summing its
+# power series until the terms stop mattering.
+def regularized_gamma(a, x):
+    lgamma = np.frompyfunc(math.lgamma, 1, 1)(a + 1).astype(float)
+    term = np.ones(np.broadcast(a, x).shape)
+    total = term.copy()
+    n = 1
+    while (term > total * 1e-17).any():
+        term = term * x / (a + n)
+        total += term
+        n += 1
+    return np.minimum(np.exp(a * np.log(x) - x - lgamma) * total, 1)
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Serves rate queries and chart images from datasets loaded once, so callers
+# don't each pay for starting Python, importing the plotting stack and
+# parsing the exports.
+#
+#   ./serve.py --port 8000
+#   ./serve.py --socket /tmp/firearm-deaths.sock
+#
+#   GET /charts                          registered charts, as JSON
+#   GET /chart/NAME.png                  a chart, rendered on demand; also
+#                                        .svg, .webp, -thumb.png, .json or
+#                                        any other format in outputs.py
+#   GET /rate?script=...&numerator=...&denominator=...&by=...&AXIS=...
+#   GET /fraction?...                    the same, as a percentage
+#   GET /adjusted?...                    the same, age-adjusted to the US
+#                                        2000 standard population
+#   GET /total?script=...&cube=...&by=...&AXIS=...
+#   GET /table/NAME.json                 a table, or .csv
+#   GET /stats                           what memo.cache is holding
+#
+# script is process or process-homicides, and numerator, denominator and
+# cube name its datasets.  by is an axis or a comma-separated list of axes.
+# Any other parameter selects along the axis it names: a label, a
+# comma-separated list of labels, or an inclusive range like 13..17.
+# causes is shorthand for cause, as in rates.rate().  interval=poisson or
+# interval=bootstrap adds the low and high ends of each rate's confidence
+# interval, from rates.interval() or bootstrap.bands(), which samples
+# across --jobs processes.  For example:
+#
+#   /rate?script=process-homicides&numerator=data&denominator=populations
+#        &by=year&gender=Male&group=Black&age=13..17
+#
+# Without a server, --get answers a request in-process, the same way the
+# server would:
+#
+#   ./serve.py --get '/total?script=process&cube=data&by=year'
+#
+# Requests are handled one at a time: matplotlib isn't thread safe.  Totals
+# and rendered charts are kept in memo.cache, within --memory megabytes.
+
+import argparse
+import http.server
+import io
+import json
+import os
+import socketserver
+import sys
+import urllib.parse
+
+import matplotlib
+matplotlib.use("Agg")
+
+import bootstrap
+import charts
+import memo
+import outputs
+import rates
+import wonder
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def dataset(script, name):
+    module = script.replace("-", "_")
+    if (module, name) not in charts.DATASETS:
+        raise QueryError(404, "no dataset %r in %r" % (name, script))
+    return charts.load(charts.DATASETS[module, name])
+
+# A selector for rates.strata from its query string form, with labels
+# converted to match the cube's.
+def selector(cube, axis, value):
+    if axis not in cube.axes:
+        raise QueryError(400, "no axis %r" % axis)
+    convert = str
+    if cube.labels[axis] and isinstance(cube.labels[axis][0], int):
+        convert = int
+    try:
+        if ".." in value:
+            low, high = value.split("..")
+            return (convert(low), convert(high))
+        if "," in value:
+            return [convert(label) for label in value.split(",")]
+        return convert(value)
+    except ValueError:
+        raise QueryError(400, "bad %s: %r" % (axis, value))
+
+def strata(cube, params, reserved):
+    result = {}
+    for axis, value in params.items():
+        if axis in reserved:
+            continue
+        if axis == "causes":
+            axis = "cause"
+        result[axis] = selector(cube, axis, value)
+    return result
+
+def by(params):
+    axes = params.get("by", "")
+    if "," in axes:
+        return tuple(axes.split(","))
+    return axes or ()
+
+def rate_query(params, per, measure=rates.rate):
+    try:
+        numerator = dataset(params["script"], params["numerator"])
+        denominator = dataset(params["script"], params["denominator"])
+    except KeyError as e:
+        raise QueryError(400, "missing %s" % e)
+    axes = by(params)
+    selected = strata(numerator, params,
+                      {"script", "numerator", "denominator", "by",
+                       "interval"})
+    standard = rates.US_2000 if measure is rates.adjusted else None
+    try:
+        xs, ys = measure(numerator, denominator, strata=selected, by=axes,
+                         per=per)
+        body = {"by": axes, "labels": outputs.jsonable(xs),
+                "values": outputs.jsonable(ys)}
+        if params.get("interval") in intervals:
+            low, high = intervals[params["interval"]](
+                numerator, denominator, strata=selected, by=axes, per=per,
+                standard=standard)
+            body["low"] = outputs.jsonable(low)
+            body["high"] = outputs.jsonable(high)
+        elif "interval" in params:
+            raise QueryError(400, "no interval %r" % params["interval"])
+    except ValueError as e:
+        raise QueryError(400, str(e))
+    return body
+
+# bootstrap.bands(), sampling across charts.JOBS processes.
+def bands(*args, **kwargs):
+    return bootstrap.bands(*args, jobs=charts.JOBS, **kwargs)
+
+intervals = {
+    "poisson": rates.interval,
+    "bootstrap": bands,
+}
+
+def total_query(params):
+    try:
+        cube = dataset(params["script"], params["cube"])
+    except KeyError as e:
+        raise QueryError(400, "missing %s" % e)
+    axes = by(params)
+    selected = strata(cube, params, {"script", "cube", "by"})
+    labels = rates.labels(cube, selected, axes)
+    if isinstance(axes, str):
+        labels, = labels
+    return {"by": axes, "labels": outputs.jsonable(labels),
+            "values": outputs.jsonable(rates.total(cube, selected, axes))}
+
+# The chart a file name like those charts.py writes stands for, in the
+# format its suffix stands for.
+def chart_image(fname):
+    for fmt in outputs.FORMATS.values():
+        name = fname[:-len(fmt.suffix)]
+        if fname.endswith(fmt.suffix) and name in charts.CHARTS:
+            return fmt.content_type, charts.CHARTS[name].image(fmt.name)
+    raise QueryError(404, "no chart %r" % fname)
+
+def table(name):
+    name, fmt = os.path.splitext(name)
+    fmt = fmt.lstrip(".") or "json"
+    if name not in charts.TABLES:
+        raise QueryError(404, "no table %r" % name)
+    if fmt not in ("csv", "json"):
+        raise QueryError(400, "can't write %r" % fmt)
+    out = io.StringIO()
+    charts.write_tables([charts.TABLES[name]], fmt, out)
+    return "text/csv" if fmt == "csv" else "application/json", out.getvalue()
+
+# Answers a request path with (status, content type, body).
+def respond(path):
+    url = urllib.parse.urlsplit(path)
+    params = dict(urllib.parse.parse_qsl(url.query))
+    try:
+        if url.path == "/charts":
+            body = [{"name": c.name, "inputs": c.inputs, "output": c.output}
+                    for c in charts.CHARTS.values()]
+        elif url.path.startswith("/chart/"):
+            content_type, image = chart_image(url.path[len("/chart/"):])
+            return 200, content_type, image
+        elif url.path.startswith("/table/"):
+            content_type, text = table(url.path[len("/table/"):])
+            return 200, content_type, text.encode()
+        elif url.path == "/rate":
+            body = rate_query(params, per=100000)
+        elif url.path == "/fraction":
+            body = rate_query(params, per=100)
+        elif url.path == "/adjusted":
+            body = rate_query(params, per=100000, measure=rates.adjusted)
+        elif url.path == "/total":
+            body = total_query(params)
+        elif url.path == "/stats":
+            body = memo.cache.stats()
+        else:
+            raise QueryError(404, "no such endpoint %r" % url.path)
+    except QueryError as e:
+        return e.status, "text/plain", (str(e) + "\n").encode()
+    except (FileNotFoundError, wonder.CoverageError) as e:
+        return 500, "text/plain", (str(e) + "\n").encode()
+    return 200, "application/json", json.dumps(body).encode()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, content_type, body = respond(self.path)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Unix socket clients have no address.
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "-"
+
+class UnixServer(socketserver.UnixStreamServer):
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+# Loads everything any chart draws on, so the first requests are as fast as
+# the rest.  Charts whose exports aren't here are left to fail on request.
+def warm():
+    for c in charts.CHARTS.values():
+        try:
+            c.load()
+        except (FileNotFoundError, wonder.CoverageError) as e:
+            print("not loading %s: %s" % (c.name, e), file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--socket", metavar="PATH",
+        help="listen on a Unix socket instead of a TCP port")
+    parser.add_argument(
+        "--memory", type=int, metavar="MB",
+        help="keep at most this much in memory of totals and rendered charts")
+    parser.add_argument(
+        "--get", metavar="PATH",
+        help="answer this request in-process and print the response")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="sample bootstrap intervals across this many processes, or "
+        "one per CPU with 0")
+    args = parser.parse_args()
+
+    charts.load_scripts()
+    charts.JOBS = args.jobs or os.cpu_count()
+    if args.memory is not None:
+        memo.cache.resize(args.memory << 20)
+
+    if args.get:
+        status, content_type, body = respond(args.get)
+        sys.stdout.buffer.write(body)
+        if status != 200:
+            sys.exit(1)
+        return
+
+    warm()
+    if args.socket:
+        server = UnixServer(args.socket, Handler)
+    else:
+        server = http.server.HTTPServer((args.host, args.port), Handler)
+    print("serving on %s" % (args.socket or "http://%s:%s" % (
+        args.host, args.port)), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main()
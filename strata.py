@@ -0,0 +1,122 @@
+# Groupings, strata and chart specs read from a JSON config, strata.json,
+# so that a new breakdown is a few lines of config rather than another copy
+# of a chart.
+#
+# groupings derive a label from other columns, by the first of their rules
+# that matches, as process-homicides.py does for race/ethnicity:
+#
+#   "group": {"columns": ["race", "hispanic"],
+#             "rules": [{"hispanic": "Hispanic or Latino",
+#                        "label": "Hispanic"},
+#                       ...,
+#                       {"label": "Other"}]}
+#
+# strata name selections over a cube's axes.  A stratum maps axes to a
+# label, a list of labels or {"from": low, "to": high}, and can also keep
+# only cells in "any" of a list of strata, or drop those in any of a list
+# under "except".  Strata in those lists are definitions or names:
+#
+#   "black-male": {"gender": "Male", "group": "Black"},
+#   "others": {"except": ["black-male", "hispanic-male"]}
+#
+# charts lists charts for a script to register, each with the kind of
+# chart it is, its output, and whatever that kind needs, typically a
+# stratum or lines of strata.
+#
+# compile() turns a stratum into strata for rates.py: plain selections stay
+# as they are, and "any" and "except" become one boolean mask over the axes
+# they mention, so each is a single masked reduction.
+
+import json
+
+import numpy as np
+
+import rates
+
+CONFIG = "strata.json"
+
+class Grouping:
+    def __init__(self, columns, rules):
+        self.columns = columns
+        self.rules = rules
+
+    def __call__(self, *levels):
+        values = dict(zip(self.columns, levels))
+        for rule in self.rules:
+            if all(matches(values[column], want)
+                   for column, want in rule.items() if column != "label"):
+                return rule["label"]
+        raise ValueError("no rule groups %s" % values)
+
+def matches(value, want):
+    return value in want if isinstance(want, list) else value == want
+
+class Config:
+    def __init__(self, fname=CONFIG):
+        self.fname = fname
+        with open(fname) as inf:
+            config = json.load(inf)
+        self.groupings = {
+            name: Grouping(grouping["columns"], grouping["rules"])
+            for name, grouping in config.get("groupings", {}).items()}
+        self.strata = config.get("strata", {})
+        self.charts = config.get("charts", [])
+
+    # The definition of a stratum, given by name or as a definition, with
+    # the strata it refers to replaced by their definitions.
+    def stratum(self, stratum, seen=()):
+        if isinstance(stratum, str):
+            if stratum in seen:
+                raise ValueError("stratum %r refers to itself" % stratum)
+            if stratum not in self.strata:
+                raise ValueError("no stratum %r in %s" % (stratum, self.fname))
+            return self.stratum(self.strata[stratum], seen + (stratum,))
+        resolved = dict(stratum)
+        for key in ["any", "except"]:
+            if key in resolved:
+                resolved[key] = [self.stratum(s, seen) for s in resolved[key]]
+        return resolved
+
+def selector(value):
+    if isinstance(value, dict):
+        return (value["from"], value["to"])
+    return value
+
+# The axes a stratum's "any" and "except" clauses select on, in the
+# cube's order.
+def mentioned(cube, stratum):
+    axes = set()
+    for key in ["any", "except"]:
+        for s in stratum.get(key, []):
+            axes.update(axis for axis in s if axis not in ("any", "except"))
+            axes.update(mentioned(cube, s))
+    return [axis for axis in cube.axes if axis in axes]
+
+# Boolean mask over axes of cube keeping the cells in stratum.
+def mask(cube, axes, stratum):
+    shape = [len(cube.labels[axis]) for axis in axes]
+    result = np.ones(shape, dtype=bool)
+    for axis, value in stratum.items():
+        if axis in ("any", "except") or axis not in axes:
+            continue
+        along = rates.keep(cube.labels[axis], selector(value))
+        result &= along.reshape(
+            [-1 if a == axis else 1 for a in axes])
+    if "any" in stratum:
+        result &= np.logical_or.reduce(
+            [mask(cube, axes, s) for s in stratum["any"]])
+    if "except" in stratum:
+        result &= ~np.logical_or.reduce(
+            [mask(cube, axes, s) for s in stratum["except"]])
+    return result
+
+# strata for rates.py selecting a resolved stratum from cube.
+def compile(cube, stratum):
+    result = {axis: selector(value) for axis, value in stratum.items()
+              if axis not in ("any", "except")}
+    axes = mentioned(cube, stratum)
+    if axes:
+        joint = {key: stratum[key] for key in ("any", "except")
+                 if key in stratum}
+        result[tuple(axes)] = mask(cube, axes, joint)
+    return result
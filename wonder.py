@@ -0,0 +1,886 @@
+#!/usr/bin/env python3
+
+# Loader for the tab-separated exports CDC WONDER produces, shared by
+# process.py and process-homicides.py.
+#
+# An export is read in a single pass.  Column positions are looked up once
+# from the header, and every field we use is appended to a typed array
+# instead of being filed away in nested dicts.
+#
+# Parsed exports are cached on disk, one .npy file per column, under a key
+# made from the export's contents and PARSER_VERSION.  Later runs map the
+# columns back in instead of parsing again, until the export changes.
+# Each file's hash is kept there too, by size and modification time, so
+# the export isn't read just to hash it either.
+#
+# Conversion streams rows to disk CHUNK_ROWS at a time, and the cached
+# columns are memory-mapped rather than read, so neither converting nor
+# aggregating an export needs it all in memory at once.  Aggregate with
+# Export.chunks() to keep it that way.
+#
+# Anywhere an export is named, a directory, a glob pattern or a list of
+# exports can be given instead, and is read as one: WONDER limits how many
+# rows a query returns, so long spans are pulled a few years at a time.
+# Exports concatenated into one file, headers, notes and all, read fine
+# too.
+
+from array import array
+import bisect
+import glob
+import hashlib
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import sys
+
+import numpy as np
+
+import instrument
+
+# Bump whenever a change here would parse the same export differently, so
+# that stale cache entries are ignored.
+PARSER_VERSION = 5
+
+# How many rows are parsed, written or aggregated at a time.
+CHUNK_ROWS = 1 << 20
+
+# Exports bigger than this are parsed in shards about this size, across
+# WONDER_JOBS processes, one per CPU by default.
+SHARD_BYTES = 32 << 20
+JOBS = int(os.environ.get("WONDER_JOBS", "0")) or os.cpu_count() or 1
+
+# Where parsed exports are cached.  Set WONDER_CACHE to an empty string to
+# turn caching off.
+CACHE_DIR = os.environ.get("WONDER_CACHE", ".wonder-cache")
+
+# Stored in numeric columns for "Not Applicable", "Suppressed" and the other
+# placeholders WONDER uses in place of a number.
+MISSING = -1
+
+# How a header line starts.
+HEADER = '"Notes"\t'
+
+# attribute -> WONDER column, for columns holding integers
+NUMERIC_COLUMNS = {
+    "year": "Year",
+    "age": "Single-Year Ages Code",
+    "deaths": "Deaths",
+    "population": "Population",
+}
+
+# attribute -> WONDER column, for columns holding decimals.  Placeholders,
+# including "Unreliable" where WONDER won't give a rate, are stored as NaN.
+DECIMAL_COLUMNS = {
+    "crude_rate": "Crude Rate",
+}
+
+# attribute -> WONDER column, for columns holding a handful of distinct
+# strings.  These are stored as small integer codes.
+CATEGORICAL_COLUMNS = {
+    "cause": "Cause of death Code",
+    "county": "County Code",
+    "gender": "Gender",
+    "race": "Race",
+    "hispanic": "Hispanic Origin",
+}
+
+def unquote(x):
+    if x.startswith('"') and x.endswith('"'):
+        return x[1:-1].strip()
+    return x
+
+def to_int(x):
+    try:
+        return int(x)
+    except ValueError:
+        return MISSING
+
+def to_float(x):
+    try:
+        return float(x)
+    except ValueError:
+        return float("NaN")
+
+COLUMN_TYPES = dict(
+    [(name, np.int64) for name in NUMERIC_COLUMNS] +
+    [(name, np.float64) for name in DECIMAL_COLUMNS] +
+    [(name, np.int16) for name in CATEGORICAL_COLUMNS])
+
+class Export:
+    # One array per column.  Numeric columns are int64, decimal columns
+    # float64, and categorical columns int16 codes indexing into
+    # levels[name].  Columns the export doesn't have are None.
+
+    def __init__(self, columns, levels):
+        self.levels = levels
+        for name in COLUMN_TYPES:
+            setattr(self, name, columns.get(name))
+
+    def __len__(self):
+        return len(self.year)
+
+    # Consecutive slices of the export, each at most CHUNK_ROWS long.  For a
+    # memory-mapped export these are views onto the cache files.
+    def chunks(self):
+        for start in range(0, len(self), CHUNK_ROWS):
+            yield self.select(slice(start, start + CHUNK_ROWS))
+
+    def has(self, name):
+        return getattr(self, name) is not None
+
+    # The strings a categorical column holds, one per row.
+    def labels(self, name):
+        return np.array(self.levels[name], dtype=object)[getattr(self, name)]
+
+    # A column in the form Cube.add() takes: the values themselves for
+    # numeric columns, a (codes, levels) pair for categorical ones.
+    def column(self, name):
+        if name in self.levels:
+            return getattr(self, name), self.levels[name]
+        return getattr(self, name)
+
+    # The distinct values of a column, sorted.
+    def distinct(self, name):
+        seen = set()
+        for chunk in self.chunks():
+            seen.update(np.unique(getattr(chunk, name)).tolist())
+        if name in self.levels:
+            return sorted(self.levels[name][code] for code in seen)
+        return sorted(seen)
+
+    # The rows where mask is true, or in the slice, as a new Export.
+    def select(self, mask):
+        columns = {}
+        for name in COLUMN_TYPES:
+            if self.has(name):
+                columns[name] = getattr(self, name)[mask]
+        return Export(columns, self.levels)
+
+    # Applies func to each combination of levels of the named categorical
+    # columns, giving a new (codes, levels) column without visiting rows one
+    # at a time.  Several combinations may share a level.
+    def derive(self, func, *names):
+        codes = np.zeros(len(self), dtype=np.int64)
+        combos = [()]
+        for name in names:
+            levels = self.levels[name]
+            codes = codes * len(levels) + getattr(self, name)
+            combos = [combo + (level,) for combo in combos for level in levels]
+        return codes, [func(*combo) for combo in combos]
+
+versions = itertools.count()
+
+class Grid:
+    # What Cube and SparseCube share: int64 counts with one axis per
+    # stratum, where labels[axis] lists, in sorted order, what each position
+    # along that axis stands for.
+
+    def __init__(self, axes, labels):
+        self.axes = list(axes)
+        self.labels = {axis: list(labels[axis]) for axis in self.axes}
+        self.shape = tuple(len(self.labels[axis]) for axis in self.axes)
+        # Changes whenever the counts do, and no two cubes share one, so it
+        # can key anything computed from them.
+        self.version = next(versions)
+        # For a denominator with holes, like populations WONDER left out, a
+        # cube over some of its axes that's nonzero where it has no count.
+        # rates.py leaves any rate taking in one of those cells undefined.
+        self.gaps = None
+
+    def axis(self, name):
+        return self.axes.index(name)
+
+    # Boolean mask along an axis, true at the given labels.
+    def mask(self, axis, labels):
+        return np.isin(self.labels[axis], labels)
+
+    # Boolean mask along a numeric axis, true from low to high inclusive.
+    def between(self, axis, low, high):
+        labels = np.array(self.labels[axis])
+        return (labels >= low) & (labels <= high)
+
+    # Where each row falls along an axis, or -1 if its label isn't there.
+    # rows is a column as returned by Export.column().
+    def positions(self, axis, rows):
+        labels = self.labels[axis]
+        if isinstance(rows, tuple):
+            codes, levels = rows
+            lookup = {label: i for i, label in enumerate(labels)}
+            table = np.array([lookup.get(level, -1) for level in levels],
+                             dtype=np.int64)
+            return table[codes]
+        labels = np.asarray(labels)
+        found = np.minimum(np.searchsorted(labels, rows), len(labels) - 1)
+        return np.where(labels[found] == rows, found, -1)
+
+    # The cell each row falls in, as an index per axis, for the rows that
+    # fall inside the cube.  coords maps every axis to a column.
+    def cells(self, coords):
+        index = [self.positions(axis, coords[axis]) for axis in self.axes]
+        keep = np.logical_and.reduce([i >= 0 for i in index])
+        return tuple(i[keep] for i in index), keep
+
+    def changed(self):
+        self.version = next(versions)
+
+class Cube(Grid):
+    # Dense counts, an array element for every cell.
+    #
+    # Running totals along an axis are kept once computed, so that a total
+    # over any range of labels along it, like an age band, costs two lookups
+    # per cell of the other axes however wide the range is.
+
+    sparse = False
+
+    def __init__(self, axes, labels):
+        Grid.__init__(self, axes, labels)
+        self.values = np.zeros(self.shape, dtype=np.int64)
+        # axis -> running totals along it
+        self.prefixes = {}
+
+    def changed(self):
+        self.prefixes.clear()
+        Grid.changed(self)
+
+    # Running totals along an axis, with a slice of zeros in front, so the
+    # total over positions i through j-1 is prefix[j] - prefix[i].
+    def prefix(self, axis):
+        if axis not in self.prefixes:
+            a = self.axis(axis)
+            shape = list(self.values.shape)
+            shape[a] = 1
+            self.prefixes[axis] = np.concatenate([
+                np.zeros(shape, dtype=np.int64),
+                np.cumsum(self.values, axis=a),
+            ], axis=a)
+        return self.prefixes[axis]
+
+    # Totals over each (low, high) range of labels, inclusive, along a
+    # numeric axis.  The result has one position per range in place of that
+    # axis.
+    def bands(self, axis, ranges):
+        labels = self.labels[axis]
+        starts = [bisect.bisect_left(labels, low) for low, high in ranges]
+        ends = [bisect.bisect_right(labels, high) for low, high in ranges]
+        prefix = self.prefix(axis)
+        a = self.axis(axis)
+        return np.take(prefix, ends, axis=a) - np.take(prefix, starts, axis=a)
+
+    # Totals from low to high inclusive along a numeric axis, with that axis
+    # summed out.
+    def band(self, axis, low, high):
+        return np.take(self.bands(axis, [(low, high)]), 0,
+                       axis=self.axis(axis))
+
+    # Adds counts[i] to the cell row i falls in; rows falling outside the
+    # cube are dropped.  Rows are totaled by cell first, so the work goes
+    # with the chunk rather than the size of the cube.
+    def add(self, coords, counts):
+        index, keep = self.cells(coords)
+        keys, sums = totals(np.ravel_multi_index(index, self.values.shape),
+                            counts[keep])
+        self.values.reshape(-1)[keys] += sums
+        self.changed()
+
+    # Sets the cell row i falls in to values[i], for values repeated on
+    # every row of a cell, like a population on the row for each cause.
+    def put(self, coords, values):
+        index, keep = self.cells(coords)
+        self.values[index] = values[keep]
+        self.changed()
+
+    # Whether each cell of the grid over axes, in that order, has anything
+    # in it, summing over the other axes.
+    def occupied(self, axes):
+        occupied = (self.values != 0).any(axis=tuple(
+            a for a, axis in enumerate(self.axes) if axis not in axes))
+        return np.transpose(occupied, [[a for a in self.axes if a in axes]
+                                       .index(axis) for axis in axes])
+
+class SparseCube(Grid):
+    # Counts like a Cube's, for grids too big to hold an element per cell,
+    # like county by cause by age by year, where most cells are zero.  Only
+    # cells with something in them are stored, in coordinate form: keys are
+    # their positions in the flattened grid, sorted, and counts what each
+    # holds.  Memory goes with those cells rather than the whole grid.
+    #
+    # rates.py totals these by grouping keys instead of summing an array;
+    # either kind of cube answers the same queries the same way.
+
+    sparse = True
+
+    def __init__(self, axes, labels):
+        Grid.__init__(self, axes, labels)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    # Each stored cell's position along every axis, as an array per axis.
+    def coords(self):
+        return np.unravel_index(self.keys, self.shape)
+
+    # Stores the totals of counts by key, leaving out cells that come to
+    # zero.
+    def merge(self, keys, counts):
+        self.store(*totals(keys, counts))
+
+    # Stores sorted, distinct keys and their counts, leaving out cells that
+    # come to zero.
+    def store(self, keys, counts):
+        nonzero = counts != 0
+        self.keys = keys[nonzero]
+        self.counts = counts[nonzero]
+        self.changed()
+
+    # Like Cube.add().  Only the chunk's keys are sorted; they're merged
+    # into the sorted keys already stored in one pass over them.
+    def add(self, coords, counts):
+        index, keep = self.cells(coords)
+        keys, counts = totals(np.ravel_multi_index(index, self.shape),
+                              counts[keep])
+        at = np.searchsorted(self.keys, keys)
+        found = at < len(self.keys)
+        found[found] = self.keys[at[found]] == keys[found]
+        stored = self.counts.copy()
+        stored[at[found]] += counts[found]
+        self.store(np.insert(self.keys, at[~found], keys[~found]),
+                   np.insert(stored, at[~found], counts[~found]))
+
+    # Like Cube.put(): where several rows fall in a cell, the last wins.
+    def put(self, coords, values):
+        index, keep = self.cells(coords)
+        keys, last = np.unique(np.ravel_multi_index(index, self.shape)[::-1],
+                               return_index=True)
+        untouched = ~np.isin(self.keys, keys)
+        self.merge(np.concatenate([self.keys[untouched], keys]),
+                   np.concatenate([self.counts[untouched],
+                                   values[keep][::-1][last]]))
+
+    def occupied(self, axes):
+        occupied = np.zeros([len(self.labels[axis]) for axis in axes],
+                            dtype=bool)
+        coords = self.coords()
+        occupied[tuple(coords[self.axis(axis)] for axis in axes)] = True
+        return occupied
+
+# The distinct keys, sorted, and the total of counts for each.
+def totals(keys, counts):
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse.ravel(), weights=counts,
+                             minlength=len(keys)).astype(np.int64)
+
+# Grids with more cells than this are held in a SparseCube rather than a
+# Cube, as are all grids with WONDER_SPARSE set.
+DENSE_CELLS = 1 << 26
+SPARSE = bool(os.environ.get("WONDER_SPARSE"))
+
+# A Cube over axes, or a SparseCube if a dense one would be too big.
+def cube(axes, labels):
+    cells = np.prod([float(len(labels[axis])) for axis in axes])
+    if SPARSE or cells > DENSE_CELLS:
+        return SparseCube(axes, labels)
+    return Cube(axes, labels)
+
+class CoverageError(ValueError):
+    pass
+
+# Checks that cube has something in every cell of the grid over the given
+# axes, summing over the others, before anything is drawn from it.  where
+# limits the grid along some axes to a (low, high) range or a list of
+# labels, for cells WONDER leaves out, like populations over 85.  Raises
+# CoverageError reporting which cells are empty, by label along each axis.
+#
+# It's a single reduction over the cube's counts, so it costs next to
+# nothing next to building the cube.
+def require(name, cube, axes, where=None):
+    where = where or {}
+    empty = ~cube.occupied(axes)
+    for a, axis in enumerate(axes):
+        if axis in where:
+            selector = where[axis]
+            along = (cube.between(axis, *selector)
+                     if isinstance(selector, tuple)
+                     else cube.mask(axis, selector))
+            empty = empty & along.reshape(
+                [-1 if b == a else 1 for b in range(len(axes))])
+    if not empty.any():
+        return
+
+    lines = ["%s: %s of %s (%s) cells are empty" % (
+        name, np.count_nonzero(empty), empty.size, ", ".join(axes))]
+    for a, axis in enumerate(axes):
+        counts = empty.sum(axis=tuple(b for b in range(len(axes)) if b != a))
+        gaps = ["%s (%s)" % (cube.labels[axis][i], counts[i])
+                for i in np.nonzero(counts)[0]]
+        lines.append("  %s: %s%s" % (axis, ", ".join(gaps[:10]),
+                                     ", ..." if len(gaps) > 10 else ""))
+    raise CoverageError("\n".join(lines))
+
+# The export files spec names: spec itself, every file in it if it's a
+# directory, the files matching it if it's a glob pattern, or those of each
+# in turn if it's a list.  "-" is stdin.
+def export_files(spec):
+    if isinstance(spec, (list, tuple)):
+        return [fname for s in spec for fname in export_files(s)]
+    if os.path.isdir(spec):
+        return sorted(os.path.join(spec, name) for name in os.listdir(spec)
+                      if not name.startswith("."))
+    if glob.has_magic(spec):
+        return sorted(glob.glob(spec))
+    return [spec]
+
+# (file name, line number, line) for every line of fnames, in order.
+# digest, if given, is updated with everything read from stdin.
+def read_lines(fnames, digest=None):
+    for fname in fnames:
+        if fname == "-":
+            for lineno, line in enumerate(sys.stdin, 1):
+                if digest is not None:
+                    digest.update(line.encode())
+                yield "<stdin>", lineno, line
+            continue
+        with open(fname) as inf:
+            for lineno, line in enumerate(inf, 1):
+                yield fname, lineno, line
+
+# (name, index) for the numeric, including decimal, and categorical columns
+# we use, given the columns of a header.
+def header_columns(cols):
+    numeric = [(name, cols.index(col))
+               for name, col in list(NUMERIC_COLUMNS.items()) +
+               list(DECIMAL_COLUMNS.items()) if col in cols]
+    categorical = [(name, cols.index(col))
+                   for name, col in CATEGORICAL_COLUMNS.items() if col in cols]
+    return numeric, categorical
+
+def empty_columns(numeric, categorical):
+    values = {name: array("d" if name in DECIMAL_COLUMNS else "q")
+              for name, index in numeric}
+    for name, index in categorical:
+        values[name] = array("h")
+    return values
+
+def finish_columns(values):
+    return {name: np.frombuffer(column, dtype=COLUMN_TYPES[name])
+            for name, column in values.items()}
+
+# Appends the fields we use from a row of an export to values, unless it's
+# one we skip.  Returns whether it did.
+def append_row(values, records, age_index, numeric, categorical, levels):
+    if unquote(records[0]) == "Total": return False
+    # Deaths with age "Not Stated" aren't broken out by age, so none of our
+    # charts can use them.
+    if unquote(records[age_index]) == "NS": return False
+
+    for name, index in numeric:
+        convert = to_float if name in DECIMAL_COLUMNS else to_int
+        values[name].append(convert(unquote(records[index])))
+    for name, index in categorical:
+        seen = levels[name]
+        value = unquote(records[index])
+        code = seen.get(value)
+        if code is None:
+            code = seen[value] = len(seen)
+        values[name].append(code)
+    return True
+
+# Parses exports CHUNK_ROWS rows at a time, yielding {name: array} for each
+# chunk.  levels is filled in with {name: {level: code}} for the categorical
+# columns as new levels turn up.
+#
+# The exports can be one after another in a single file, as when exports
+# for separate year ranges are concatenated: a header starts each one, and
+# its notes, from the "---" line to the next header, are skipped.  Each
+# header must have the columns the first one did, though not necessarily
+# in the same order.
+def parse_chunks(fnames, levels, digest=None):
+    names = None
+    cols = None
+    notes = False
+    values = None
+    rows = 0
+    yielded = False
+    for fname, lineno, line in split_headers(read_lines(fnames, digest)):
+        records = line.rstrip("\r\n").split("\t")
+        first = unquote(records[0])
+
+        if lineno == 1 or first == "Notes" and len(records) > 1:
+            cols = [unquote(x) for x in records]
+            numeric, categorical = header_columns(cols)
+            names = check_header(names, numeric + categorical, fname, lineno)
+            for name, index in categorical:
+                levels.setdefault(name, {})
+            age_index = cols.index(NUMERIC_COLUMNS["age"])
+            if values is None:
+                values = empty_columns(numeric, categorical)
+            notes = False
+            continue
+
+        if first == "---":
+            notes = True
+        if notes and len(records) == len(cols):
+            raise ValueError("%s:%s: a row in the notes; is the header of "
+                             "the export it belongs to missing?" % (
+                                 fname, lineno))
+        if notes or not line.strip():
+            continue
+        if len(records) != len(cols):
+            raise ValueError("%s:%s: expected %s fields, found %s" % (
+                fname, lineno, len(cols), len(records)))
+        if not append_row(values, records, age_index, numeric, categorical,
+                          levels):
+            continue
+
+        rows += 1
+        if rows == CHUNK_ROWS:
+            yield finish_columns(values)
+            values = empty_columns(numeric, categorical)
+            rows = 0
+            yielded = True
+
+    if values is not None and (rows or not yielded):
+        yield finish_columns(values)
+
+# WONDER exports don't end with a newline, so when they're concatenated
+# each header after the first is glued onto the last line of the notes
+# before it.  Splits such lines in two, at the header.
+def split_headers(lines):
+    for fname, lineno, line in lines:
+        at = line.find(HEADER, 1)
+        if at > 0:
+            yield fname, lineno, line[:at] + "\n"
+            line = line[at:]
+        yield fname, lineno, line
+
+# The names of the columns a header has, which must be those of the headers
+# before it, if any.
+def check_header(names, columns, fname, where):
+    header = [name for name, index in columns]
+    if names is not None and sorted(header) != sorted(names):
+        raise ValueError("%s:%s: has columns %s, not %s like the exports "
+                         "before it" % (fname, where, header, names))
+    return header
+
+# Splits fname into shards of about SHARD_BYTES, each a byte range of whole
+# rows along with the header they fall under.  Headers and notes, which
+# parse_chunks() finds line by line, are found here by searching for them,
+# so that shards never need to look outside their own range.
+def plan_shards(fname):
+    with open(fname, "rb") as inf:
+        data = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(fname) else b""
+    try:
+        # Like split_headers(), a header can start partway through a line.
+        headers = [0] + find_all(data, HEADER.encode())
+        notes = find_lines(data, b'"---"')
+        shards = []
+        for i, start in enumerate(headers):
+            end = data.find(b"\n", start)
+            end = len(data) if end < 0 else end + 1
+            cols = [unquote(x) for x in data[start:end].decode()
+                    .rstrip("\r\n").split("\t")]
+            stop = min([p for p in notes + headers[i + 1:] if p >= end]
+                       or [len(data)])
+            shards.extend((fname, a, b, cols)
+                          for a, b in split_range(data, end, stop))
+            check_notes(data, fname, cols, [n for n in notes if n >= end],
+                        headers[i + 1:] + [len(data)])
+        return shards
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+# Offsets of the lines of data that start with prefix, other than the first.
+def find_lines(data, prefix):
+    found = []
+    at = data.find(b"\n" + prefix)
+    while at >= 0:
+        found.append(at + 1)
+        at = data.find(b"\n" + prefix, at + 1)
+    return found
+
+# Offsets of every occurrence of text in data, other than at the start.
+def find_all(data, text):
+    found = []
+    at = data.find(text, 1)
+    while at >= 0:
+        found.append(at)
+        at = data.find(text, at + 1)
+    return found
+
+# Raises, as parse_chunks() would, if the notes block after a header, which
+# runs to the next header, has a row in it.
+def check_notes(data, fname, cols, notes, headers):
+    if not notes:
+        return
+    start = notes[0]
+    stop = min(p for p in headers if p > start)
+    for line in data[start:stop].split(b"\n"):
+        if line.count(b"\t") == len(cols) - 1:
+            lineno = data[:start].count(b"\n") + 1
+            raise ValueError("%s:%s: a row in the notes; is the header of "
+                             "the export it belongs to missing?" % (
+                                 fname, lineno))
+        start += len(line) + 1
+
+# Splits [start, stop) of data into ranges of about SHARD_BYTES, each
+# ending at the end of a line.  There's always at least one.
+def split_range(data, start, stop):
+    ranges = []
+    while True:
+        end = data.find(b"\n", min(start + SHARD_BYTES, stop) - 1, stop)
+        end = stop if end < 0 or start + SHARD_BYTES >= stop else end + 1
+        ranges.append((start, end))
+        if end >= stop:
+            return ranges
+        start = end
+
+# Parses one shard, in a pool worker.  Returns its columns and the levels
+# it saw, in the order they were coded, to be merged by parse_sharded().
+def parse_shard(shard):
+    fname, start, end, cols = shard
+    with open(fname, "rb") as inf:
+        inf.seek(start)
+        text = inf.read(end - start).decode()
+
+    numeric, categorical = header_columns(cols)
+    levels = {name: {} for name, index in categorical}
+    age_index = cols.index(NUMERIC_COLUMNS["age"])
+    values = empty_columns(numeric, categorical)
+    for i, line in enumerate(text.split("\n")):
+        records = line.rstrip("\r").split("\t")
+        if not line.strip():
+            continue
+        if len(records) != len(cols):
+            with open(fname, "rb") as inf:
+                lineno = inf.read(start).count(b"\n") + i + 1
+            raise ValueError("%s:%s: expected %s fields, found %s" % (
+                fname, lineno, len(cols), len(records)))
+        append_row(values, records, age_index, numeric, categorical, levels)
+    return (finish_columns(values),
+            {name: list(seen) for name, seen in levels.items()})
+
+# Like parse_chunks(), but splits the files into shards and parses them
+# across jobs processes.  Each shard codes categorical columns its own way;
+# the codes are mapped onto levels as shards come back, in order, so the
+# result is just what parse_chunks() would give.
+def parse_sharded(fnames, levels, jobs):
+    shards = [shard for fname in fnames for shard in plan_shards(fname)]
+    names = None
+    for fname, start, end, cols in shards:
+        names = check_header(names, sum(header_columns(cols), []), fname,
+                             "byte %s" % start)
+
+    with multiprocessing.Pool(min(jobs, len(shards))) as pool:
+        for values, shard_levels in pool.imap(parse_shard, shards):
+            for name, shard_seen in shard_levels.items():
+                seen = levels.setdefault(name, {})
+                lookup = np.array([seen.setdefault(level, len(seen))
+                                   for level in shard_seen],
+                                  dtype=COLUMN_TYPES[name])
+                if len(lookup):
+                    values[name] = lookup[values[name]]
+            yield values
+
+# Parses exports with parse_chunks(), or with parse_sharded() when they're
+# large enough to be worth splitting.
+def parse(fnames, levels, digest=None, jobs=None):
+    jobs = jobs or JOBS
+    if (jobs > 1 and "-" not in fnames
+            and max([os.path.getsize(f) for f in fnames] or [0])
+            > SHARD_BYTES):
+        return parse_sharded(fnames, levels, jobs)
+    return parse_chunks(fnames, levels, digest)
+
+def parse_export(spec, jobs=None):
+    levels = {}
+    chunks = list(parse(export_files(spec), levels, jobs=jobs))
+    columns = {}
+    for name in chunks[0] if chunks else []:
+        columns[name] = np.concatenate([chunk[name] for chunk in chunks])
+    return Export(columns, {name: list(seen) for name, seen in levels.items()})
+
+class ColumnWriter:
+    # Appends to a one-dimensional .npy file.  The header is written for an
+    # absurdly long array to reserve room, and patched with the real length
+    # on close.
+
+    def __init__(self, fname, dtype):
+        self.outf = open(fname, "wb")
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.write_header(1 << 62)
+        self.header_size = self.outf.tell()
+
+    def write_header(self, rows):
+        np.lib.format.write_array_header_1_0(self.outf, {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (rows,),
+        })
+
+    def append(self, values):
+        self.outf.write(np.ascontiguousarray(values, self.dtype).tobytes())
+        self.rows += len(values)
+
+    def close(self):
+        self.outf.seek(0)
+        self.write_header(self.rows)
+        assert self.outf.tell() == self.header_size
+        self.outf.close()
+
+# Parses the exports spec names into a cache entry without holding more
+# than a chunk of them in memory.  Returns the entry's path, which for
+# stdin is only known once it's all been read.
+def convert_export(spec, path=None, jobs=None):
+    tmp = "%s.%s.tmp" % (path or os.path.join(CACHE_DIR, "stdin"),
+                         os.getpid())
+    os.makedirs(tmp)
+    digest = hashlib.sha256()
+    levels = {}
+    writers = {}
+    for chunk in parse(export_files(spec), levels, digest, jobs):
+        for name, values in chunk.items():
+            if name not in writers:
+                writers[name] = ColumnWriter(
+                    os.path.join(tmp, name + ".npy"), COLUMN_TYPES[name])
+            writers[name].append(values)
+    for writer in writers.values():
+        writer.close()
+    with open(os.path.join(tmp, "levels.json"), "w") as outf:
+        json.dump({name: list(seen) for name, seen in levels.items()}, outf)
+    if path is None:
+        path = os.path.join(CACHE_DIR, "stdin-%s-v%s" % (
+            digest.hexdigest()[:16], PARSER_VERSION))
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # Another run got there first.
+        shutil.rmtree(tmp)
+    return path
+
+# [path, size, mtime], as JSON -> sha256, so each file is hashed once.
+# Kept in HASHES under CACHE_DIR, so that's once until it changes rather
+# than once per run.  Read on first use.
+hashes = None
+HASHES = "hashes.json"
+
+def file_hash(fname):
+    global hashes
+    if hashes is None:
+        hashes = read_hashes()
+    stat = os.stat(fname)
+    key = json.dumps([os.path.abspath(fname), stat.st_size, stat.st_mtime_ns])
+    if key not in hashes:
+        digest = hashlib.sha256()
+        with open(fname, "rb") as inf:
+            for chunk in iter(lambda: inf.read(1 << 20), b""):
+                digest.update(chunk)
+        hashes[key] = digest.hexdigest()
+        write_hashes()
+    return hashes[key]
+
+def read_hashes():
+    if CACHE_DIR:
+        try:
+            with open(os.path.join(CACHE_DIR, HASHES)) as inf:
+                return json.load(inf)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+# Writes out hashes, less those of files that have since changed or gone,
+# like charts that have been redrawn.
+def write_hashes():
+    if not CACHE_DIR:
+        return
+    current = {}
+    for key, value in hashes.items():
+        path, size, mtime = json.loads(key)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+            current[key] = value
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, HASHES)
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp, "w") as outf:
+        json.dump(current, outf, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+# Hash of the exports spec names.  For a single file, that of the file.
+def source_hash(spec):
+    if isinstance(spec, str) and os.path.isfile(spec):
+        return file_hash(spec)
+    digest = hashlib.sha256()
+    for fname in export_files(spec):
+        digest.update(("%s %s\n" % (
+            os.path.basename(fname), file_hash(fname))).encode())
+    return digest.hexdigest()
+
+def cache_name(spec):
+    if isinstance(spec, (list, tuple)):
+        return "+".join(cache_name(s) for s in spec)
+    if glob.has_magic(spec):
+        return "".join("_" if c in "/*?[]" + os.sep else c
+                       for c in os.path.normpath(spec))
+    return os.path.basename(os.path.normpath(spec))
+
+def cache_path(spec):
+    return os.path.join(CACHE_DIR, "%s-%s-v%s" % (
+        cache_name(spec), source_hash(spec)[:16], PARSER_VERSION))
+
+def load_export(path):
+    columns = {}
+    for name in COLUMN_TYPES:
+        column_path = os.path.join(path, name + ".npy")
+        if os.path.exists(column_path):
+            columns[name] = np.load(column_path, mmap_mode="r")
+    with open(os.path.join(path, "levels.json")) as inf:
+        levels = json.load(inf)
+    return Export(columns, levels)
+
+# Entries for earlier versions of spec's exports, or for an older parser.
+def stale_cache_entries(spec, path):
+    pattern = "%s-%s-v*" % (glob.escape(cache_name(spec)), "?" * 16)
+    return [entry for entry in glob.glob(os.path.join(CACHE_DIR, pattern))
+            if entry != path and not entry.endswith(".tmp")]
+
+# Reads the exports spec names, as export_files() finds them, as one.
+def read_export(spec, cache=True):
+    if not cache or not CACHE_DIR:
+        with instrument.phase("parse %s" % cache_name(spec)) as phase:
+            export = parse_export(spec)
+            phase.rows = len(export)
+        return export
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    stdin = "-" in export_files(spec)
+    path = None if stdin else cache_path(spec)
+    if path and os.path.isdir(path):
+        with instrument.phase("load %s" % cache_name(spec)) as phase:
+            export = load_export(path)
+            phase.rows = len(export)
+        return export
+
+    with instrument.phase(
+            "parse %s" % ("stdin" if stdin else cache_name(spec))) as phase:
+        path = convert_export(spec, path)
+        export = load_export(path)
+        phase.rows = len(export)
+    for entry in stale_cache_entries("stdin" if stdin else spec, path):
+        shutil.rmtree(entry, ignore_errors=True)
+    return export
+
+# Converting ahead of time, e.g. as its own CI step:
+#   ./wonder.py cdc.tsv cdc-all-deaths.txt
+# A directory, a glob or - for stdin is read as one export:
+#   cat cdc-1999-2009.tsv cdc-2010-2020.tsv | ./wonder.py -
+#   ./wonder.py exports/
+if __name__ == "__main__":
+    for spec in sys.argv[1:]:
+        print(spec, len(read_export(spec)))